@@ -0,0 +1,359 @@
+"""Time catformer's hot paths the same way every time.
+
+    python benchmark.py                           # run every case
+    python benchmark.py draw step                 # only cases named like these
+    python benchmark.py --save baseline.json      # keep the results
+    python benchmark.py --baseline baseline.json  # and compare against them
+
+Everything runs under SDL's dummy video and audio drivers, so there's no
+window or sound card involved, and with fixed seeds, so every run does
+the same work. Each case is warmed up first, then timed call by call;
+the median and 95th percentile of those calls are what gets reported and
+saved. Comparing against a baseline exits with status 1 if any case's
+median got slower by more than the tolerance.
+"""
+import os
+# before pygame gets a chance to look
+os.environ['SDL_VIDEODRIVER'] = 'dummy'
+os.environ['SDL_AUDIODRIVER'] = 'dummy'
+
+import argparse
+import atexit
+import json
+import platform
+import random
+import shutil
+import sys
+import tempfile
+from collections import OrderedDict
+from timeit import default_timer as clock
+from xml.etree import ElementTree
+
+import numpy
+import pygame
+import pymunk
+from pymunk import Vec2d
+
+LEVEL = 'levels/level.tmx'
+TICK = 1. / 60
+
+CASES = OrderedDict()  # name -> function that sets up and returns a call
+
+
+def case(name, warmup=3, repeats=20):
+    """Register a benchmark: the decorated function does any setting up
+    and returns what to time, which is called with no arguments."""
+    def register(setup):
+        CASES[name] = (setup, warmup, repeats)
+        return setup
+    return register
+
+
+def synthetic_level(directory, repeat):
+    """Write a TMX of `LEVEL` repeated `repeat` times each way, with its
+    platforms copied across too, and return its filename in `directory`."""
+    tree = ElementTree.parse(LEVEL)
+    root = tree.getroot()
+    width, height = int(root.get('width')), int(root.get('height'))
+    pixel_width = width * int(root.get('tilewidth'))
+    pixel_height = height * int(root.get('tileheight'))
+    root.set('width', str(width * repeat))
+    root.set('height', str(height * repeat))
+    for layer in root.findall('layer'):
+        layer.set('width', str(width * repeat))
+        layer.set('height', str(height * repeat))
+        data = layer.find('data')
+        rows = [r.rstrip(',') for r in data.text.strip().split('\n')]
+        row_text = [','.join([r] * repeat) for r in rows]
+        data.text = '\n' + ',\n'.join(row_text * repeat) + '\n'
+
+    for group in root.findall('objectgroup'):
+        objects = list(group.findall('object'))
+        for obj in objects:
+            group.remove(obj)
+        for i in range(repeat):
+            for j in range(repeat):
+                for obj in objects:
+                    copy = ElementTree.fromstring(ElementTree.tostring(obj))
+                    copy.set('x', str(int(copy.get('x')) + i * pixel_width))
+                    copy.set('y', str(int(copy.get('y')) + j * pixel_height))
+                    group.append(copy)
+
+    filename = os.path.join(directory, 'large{}.tmx'.format(repeat))
+    tree.write(filename)
+    return filename
+
+
+def make_match(players=4, render=False, boxes=False):
+    from main import create_match
+    return create_match(LEVEL, render=render, players=players, boxes=boxes)
+
+
+def cameras(world, count):
+    """`count` camera positions spread in a grid over the whole level."""
+    side = int(count ** .5)
+    return [Vec2d(world.map_size.x * (i + .5) / side,
+                  world.map_size.y * (j + .5) / side)
+            for i in range(side) for j in range(side)]
+
+
+@case("load level.tmx", repeats=10)
+def load_level():
+    from game.world import TileWorld
+    return lambda: TileWorld(pymunk.Space(), LEVEL)
+
+
+def _load_large(repeat):
+    from game.world import TileWorld
+    directory = tempfile.mkdtemp(prefix='catformer-bench-')
+    atexit.register(shutil.rmtree, directory, True)
+    filename = synthetic_level(directory, repeat)
+    return lambda: TileWorld(pymunk.Space(), filename)
+
+
+case("load 200x200 map", warmup=1, repeats=5)(lambda: _load_large(4))
+case("load 400x400 map", warmup=1, repeats=3)(lambda: _load_large(8))
+
+
+@case("generate_surface, whole layer")
+def generate_layer():
+    from game.world import TileWorld
+    world = TileWorld(pymunk.Space(), LEVEL)
+    data = world.layers[0]
+    surf = pygame.Surface(world.map_size, pygame.SRCALPHA, 32)
+    return lambda: world.generate_surface(surf, data)
+
+
+@case("generate_surface, one chunk", repeats=200)
+def generate_chunk():
+    from game.world import CHUNK_TILES, TileWorld
+    world = TileWorld(pymunk.Space(), LEVEL)
+    data = world.layers[0][:CHUNK_TILES, :CHUNK_TILES]
+    surf = pygame.Surface(world.chunk_size, pygame.SRCALPHA, 32)
+    return lambda: world.generate_surface(surf, data)
+
+
+def _draw_world(cold):
+    from game.world import TileWorld
+    world = TileWorld(pymunk.Space(), LEVEL)
+    screen = pygame.display.get_surface()
+    views = cameras(world, 64)
+
+    def draw():
+        if cold:
+            world.chunks.invalidate()
+        for camera in views:
+            world.draw(screen, camera)
+    return draw
+
+
+case("TileWorld.draw, 64 cameras")(lambda: _draw_world(False))
+case("TileWorld.draw, 64 cameras, cold")(lambda: _draw_world(True))
+
+
+def _step(players, bullets, whole_match, boxes=False):
+    from game.bots import BatchInput, ChaseController
+    match = make_match(players, boxes=boxes)
+    bots = BatchInput(ChaseController(seed=0))
+    shooters = match.players
+
+    def step():
+        missing = bullets - len(match.bullets)
+        for i in range(missing):
+            match.bullets.fire(shooters[i % len(shooters)])
+        if whole_match:
+            match.step(bots(match.frame, match.players), TICK)
+        else:
+            for player in match.players:
+                player.prepare_step()
+            match.space.step(TICK)
+    return step
+
+
+for _players, _bullets in ((4, 0), (16, 64), (64, 256)):
+    # bullets aren't in the space, so they only count for the whole match
+    case("space.step, {} players".format(_players),
+         repeats=200)(lambda p=_players: _step(p, 0, False))
+    case("Match.step, {} players, {} bullets".format(_players, _bullets),
+         repeats=200)(lambda p=_players, b=_bullets: _step(p, b, True))
+case("space.step, 16 players, boxes",
+     repeats=200)(lambda: _step(16, 0, False, True))
+
+
+@case("BulletPool.step, 256 bullets, 16 players", repeats=200)
+def bullets_step():
+    match = make_match(16)
+    match.step({}, TICK)
+    bullets = match.bullets
+
+    def step():
+        missing = 256 - len(bullets)
+        for i in range(missing):
+            bullets.fire(match.players[i % 16])
+        bullets.step(TICK)
+    return step
+
+
+@case("Player.update, 16 players", repeats=200)
+def player_update():
+    match = make_match(16)
+    match.step({}, TICK)  # land, or at least start falling
+
+    def update():
+        for player in match.players:
+            player.update({})
+    return update
+
+
+@case("Player.draw, 16 players", repeats=100)
+def player_draw():
+    match = make_match(16, render=True)
+    match.step({}, TICK)
+    screen = pygame.display.get_surface()
+    camera = match.world.camera
+
+    def draw():
+        for player in match.players:
+            player.draw(screen, camera, .5)
+    return draw
+
+
+@case("Animation.draw, 100 frames", repeats=100)
+def animation_draw():
+    match = make_match(1, render=True)
+    animation = match.players[0].animation
+    screen = pygame.display.get_surface()
+    position = Vec2d(screen.get_size()) / 2
+
+    def draw():
+        for i in range(100):
+            animation.tick()
+            animation.draw(screen, position, i % 2)
+    return draw
+
+
+@case("Match.draw, 64 players, 256 bullets, spread out", repeats=100)
+def match_draw():
+    from main import create_match
+    directory = tempfile.mkdtemp(prefix='catformer-bench-')
+    atexit.register(shutil.rmtree, directory, True)
+    match = create_match(synthetic_level(directory, 4), players=64)
+    size = match.world.map_size
+    for i, player in enumerate(match.players):
+        player.body.position = Vec2d(size.x * (i % 8 + .5) / 8,
+                                     size.y * (i // 8 + .5) / 8)
+        player.previous_position = Vec2d(player.body.position)
+    for i in range(256):
+        match.bullets.fire(match.players[i % 64])
+    match.step({}, TICK)
+    match.world.camera = match.world.previous_camera = size / 2
+    screen = pygame.display.get_surface()
+    return lambda: match.draw(screen, .5)
+
+
+def measure(setup, warmup, repeats):
+    """Milliseconds taken by each of `repeats` calls after `warmup`."""
+    random.seed(0)
+    numpy.random.seed(0)
+    call = setup()
+    for _ in range(warmup):
+        call()
+    times = []
+    for _ in range(repeats):
+        start = clock()
+        call()
+        times.append((clock() - start) * 1000.)
+    return times
+
+
+def summarize(times):
+    ordered = sorted(times)
+    last = len(ordered) - 1
+    return OrderedDict((
+        ('median_ms', ordered[last // 2]),
+        ('p95_ms', ordered[int(last * .95)]),
+        ('min_ms', ordered[0]),
+        ('repeats', len(ordered)),
+    ))
+
+
+def environment():
+    return OrderedDict((
+        ('python', platform.python_version()),
+        ('pygame', pygame.version.ver),
+        ('pymunk', getattr(pymunk, 'version', '?')),
+        ('numpy', numpy.__version__),
+        ('machine', platform.machine()),
+        ('system', platform.system()),
+    ))
+
+
+def run(names=(), baseline=None, tolerance=.1, repeat_scale=1.):
+    """Run every case whose name contains one of `names` (or all of them),
+    printing each as it finishes. Returns the results and the names of
+    any cases slower than `baseline` by more than `tolerance`."""
+    results = OrderedDict()
+    slower = []
+    print("{:<40}{:>10}{:>10}{:>10}".format("", "median", "p95", "vs base"))
+    for name, (setup, warmup, repeats) in CASES.items():
+        if names and not any(n in name for n in names):
+            continue
+        times = measure(setup, warmup, max(int(repeats * repeat_scale), 1))
+        result = results[name] = summarize(times)
+        change = ""
+        base = (baseline or {}).get(name)
+        if base:
+            ratio = result['median_ms'] / base['median_ms']
+            change = "{:+.0%}".format(ratio - 1)
+            if ratio > 1 + tolerance:
+                slower.append(name)
+                change += " !"
+        print("{:<40}{:>10.3f}{:>10.3f}{:>10}".format(
+            name, result['median_ms'], result['p95_ms'], change))
+        sys.stdout.flush()
+    return results, slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('names', nargs='*',
+                        help="only run cases with any of these in the name")
+    parser.add_argument('--save', metavar='FILE',
+                        help="write the results to a JSON baseline")
+    parser.add_argument('--baseline', metavar='FILE',
+                        help="compare against a baseline saved earlier")
+    parser.add_argument('--tolerance', type=float, default=.1,
+                        help="how much slower than the baseline is too slow")
+    parser.add_argument('--quick', action='store_true',
+                        help="a tenth of the repeats, for a rough idea")
+    parser.add_argument('--list', action='store_true',
+                        help="list the cases and stop")
+    args = parser.parse_args(argv)
+
+    if args.list:
+        for name in CASES:
+            print(name)
+        return 0
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['cases']
+
+    pygame.init()
+    pygame.display.set_mode((1200, 900))
+    results, slower = run(args.names, baseline, args.tolerance,
+                          .1 if args.quick else 1.)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(OrderedDict((('environment', environment()),
+                                   ('cases', results))), f, indent=1)
+    if slower:
+        print("Slower than the baseline: {}".format(", ".join(slower)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,5 +1,4 @@
 """A simple place to store game-wide constants!"""
-import pymunk
 from pymunk.vec2d import Vec2d
 
 # Some screen initialization constants
@@ -7,8 +6,7 @@ SCREEN_SIZE = Vec2d(1200, 900)
 SCREEN_HALF = SCREEN_SIZE / 2
 
 # Physics constants
-SPACE = pymunk.Space()
+GRAVITY = (0, -1000)  # in px/sec^2
 # If we were using Python 3, we'd use an IntEnum
 PLAYER_COLLISION_TYPE = 1
-JUMP_THROUGH_COLLISION_TYPE = 2
-BULLET_COLLISION_TYPE = 3
\ No newline at end of file
+JUMP_THROUGH_COLLISION_TYPE = 2
\ No newline at end of file
@@ -0,0 +1,195 @@
+"""Every image and sound the game uses, loaded once and shared."""
+import threading
+
+import pygame
+
+
+class _SilentSound(object):
+    """Stands in for a sound when the mixer isn't running (headless)."""
+    def play(self, *args, **kwargs):
+        pass
+
+    def set_volume(self, volume):
+        pass
+
+
+def convert(surface):
+    """Convert a surface to the display's pixel format, if there is one.
+
+    Blitting a converted surface is much cheaper than converting on the
+    fly every frame, but without a display there's nothing to convert to.
+    """
+    if pygame.display.get_surface() is None:
+        return surface
+    return surface.convert_alpha()
+
+
+class SpriteSheet(object):
+    """A sprite sheet cut up into separate frames.
+
+    Each frame is trimmed down to its visible pixels and kept facing both
+    ways, so drawing one is a small blit of a ready-made surface. Frames
+    are cut the first time they're asked for; `slice_all` cuts the lot up
+    front and lets go of the sheet itself.
+    """
+    def __init__(self, filename, frame_size=128):
+        self.filename = filename
+        self.frame_size = frame_size
+        self.frames = {}
+        self.img = None
+
+    def frame(self, row, col, flip=False, scale=1):
+        """A ``(surface, offset)`` pair for one frame, where `offset` is
+        where the trimmed surface goes relative to the frame's top left
+        corner. The surface is None if the frame is blank. Frames shrunk
+        by `scale` are cut from the full size ones and kept as well."""
+        key = (row, col, flip, scale)
+        frame = self.frames.get(key)
+        if frame is None:
+            frame = self.frames[key] = self.cut(row, col, flip, scale)
+        return frame
+
+    def cut(self, row, col, flip, scale=1):
+        if scale != 1:
+            surf, (x, y) = self.frame(row, col, flip)
+            if surf is None:
+                return None, (0, 0)
+            width, height = surf.get_size()
+            size = (max(int(round(width * scale)), 1),
+                    max(int(round(height * scale)), 1))
+            return (pygame.transform.smoothscale(surf, size),
+                    (int(round(x * scale)), int(round(y * scale))))
+
+        if flip:
+            surf, (x, y) = self.frame(row, col)
+            if surf is None:
+                return None, (0, 0)
+            x = self.frame_size - x - surf.get_width()
+            return pygame.transform.flip(surf, True, False), (x, y)
+
+        if self.img is None:
+            self.img = pygame.image.load(self.filename)
+        size = self.frame_size
+        frame = self.img.subsurface((col*size, row*size, size, size))
+        rect = frame.get_bounding_rect()
+        if not rect.width or not rect.height:
+            return None, (0, 0)
+        return convert(frame.subsurface(rect).copy()), rect.topleft
+
+    def slice_all(self):
+        if self.img is None:
+            self.img = pygame.image.load(self.filename)
+        rows = self.img.get_height() // self.frame_size
+        cols = self.img.get_width() // self.frame_size
+        for row in range(rows):
+            for col in range(cols):
+                self.frame(row, col)
+                self.frame(row, col, flip=True)
+        self.img = None  # every frame is cut, so the sheet can go
+
+
+class Assets(object):
+    def __init__(self):
+        self.images = {}
+        self.sheets = {}
+        self.sounds = {}
+        self.lock = threading.Lock()
+
+    def image(self, filename, flip=False):
+        """A shared image, optionally mirrored left to right.
+
+        Don't draw on it; everybody else is using it too.
+        """
+        key = (filename, flip)
+        with self.lock:
+            img = self.images.get(key)
+        if img is not None:
+            return img
+        if flip:
+            img = pygame.transform.flip(self.image(filename), True, False)
+        else:
+            img = convert(pygame.image.load(filename))
+        with self.lock:
+            return self.images.setdefault(key, img)
+
+    def sheet(self, filename):
+        """A shared sprite sheet, cut into frames as they're needed."""
+        with self.lock:
+            return self.sheets.setdefault(filename, SpriteSheet(filename))
+
+    def sound(self, filename):
+        """A shared, already decoded sound."""
+        with self.lock:
+            sound = self.sounds.get(filename)
+        if sound is not None:
+            return sound
+        if not pygame.mixer.get_init():
+            sound = _SilentSound()
+        else:
+            sound = pygame.mixer.Sound(filename)
+        with self.lock:
+            return self.sounds.setdefault(filename, sound)
+
+    def preload(self, manifest, progress=None):
+        """Load everything in a manifest of ``{'images': [...],
+        'sheets': [...], 'sounds': [...]}``, calling
+        ``progress(done, total)`` as it goes."""
+        images = manifest.get('images', [])
+        sheets = manifest.get('sheets', [])
+        sounds = manifest.get('sounds', [])
+        total = len(images) + len(sheets) + len(sounds)
+        done = 0
+        for filename in images:
+            self.image(filename)
+            done += 1
+            if progress:
+                progress(done, total)
+        for filename in sheets:
+            self.sheet(filename).slice_all()
+            done += 1
+            if progress:
+                progress(done, total)
+        for filename in sounds:
+            self.sound(filename)
+            done += 1
+            if progress:
+                progress(done, total)
+
+    def preload_in_background(self, manifest):
+        loader = Preloader(self, manifest)
+        loader.start()
+        return loader
+
+
+class Preloader(threading.Thread):
+    """Preloads a manifest on a background thread.
+
+    Poll `progress` (0 to 1) to draw a loading screen, then call `finish`
+    once `is_alive()` is False to re-raise anything that went wrong.
+    """
+    def __init__(self, assets, manifest):
+        super(Preloader, self).__init__()
+        self.daemon = True
+        self.assets = assets
+        self.manifest = manifest
+        self.progress = 0.
+        self.error = None
+
+    def run(self):
+        try:
+            self.assets.preload(self.manifest, self.report)
+        except Exception as e:
+            self.error = e
+        self.progress = 1.
+
+    def report(self, done, total):
+        self.progress = float(done) / total
+
+    def finish(self):
+        self.join()
+        if self.error is not None:
+            raise self.error
+
+
+# The whole game shares one cache
+ASSETS = Assets()
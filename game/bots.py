@@ -0,0 +1,170 @@
+"""Computer-controlled stand-ins for the people at the keyboard."""
+import random
+
+import numpy
+from game.controls import ACTIONS, action_key
+from game.replay import hold_counts
+
+
+class RandomBot(object):
+    """Mashes one player's buttons, sticking with each choice for a while."""
+    def __init__(self, player, rng):
+        self.player = player
+        self.rng = rng
+        self.held = set()
+        self.hold_for = 0
+
+    def keys(self):
+        """The keys this bot is holding down this tick."""
+        if self.hold_for <= 0:
+            self.hold_for = self.rng.randint(5, 30)
+            p = self.player
+            self.held = set()
+            direction = self.rng.choice([p.left_key, p.right_key, None])
+            if direction is not None:
+                self.held.add(direction)
+            if self.rng.random() < .3:
+                self.held.add(p.jump_key)
+            if self.rng.random() < .5:
+                self.held.add(p.shoot_key)
+        self.hold_for -= 1
+        return self.held
+
+
+class BotInput(object):
+    """An input source that lets a bot drive every player.
+
+    Call it once per tick like ``run_headless`` does; it returns the same
+    key -> hold count mapping that ``calculate_input`` builds from the
+    keyboard.
+    """
+    def __init__(self, seed=None, bot_class=RandomBot):
+        self.rng = random.Random(seed)
+        self.bot_class = bot_class
+        self.bots = None
+        self.pressed_keys = {}
+
+    def __call__(self, frame, players):
+        if self.bots is None:
+            self.bots = [self.bot_class(p, self.rng) for p in players]
+        held = set()
+        for bot in self.bots:
+            held.update(bot.keys())
+        for k in held:
+            self.pressed_keys[k] = self.pressed_keys.get(k, 0) + 1
+        for k in list(self.pressed_keys.keys()):
+            if k not in held:
+                del self.pressed_keys[k]
+        return self.pressed_keys
+
+
+# What a batched controller gets told about every player, one row each
+PLAYER_DTYPE = numpy.dtype([
+    ('position', '<f8', 2),
+    ('velocity', '<f8', 2),
+    ('health', '<i4'),
+    ('jumps', '<i4'),  # jumps left before landing again
+    ('bullets', '<i4'),  # of theirs still flying
+])
+# ... and about every bullet in flight
+BULLET_DTYPE = numpy.dtype([
+    ('position', '<f8', 2),
+    ('velocity', '<f8', 2),
+    ('owner', '<i4'),  # row of the player who fired it
+])
+
+# Input mask bits, in ACTIONS order
+JUMP, LEFT, RIGHT, DOWN, SHOOT = (1 << i for i in range(len(ACTIONS)))
+
+# Players only bots play get made-up keys, well clear of any real ones
+BOT_KEYS = 1 << 32
+
+
+def bot_keys(index):
+    """Key bindings for the `index`th bot-only player."""
+    first = BOT_KEYS + index * len(ACTIONS)
+    return dict(zip(('up', 'left', 'right', 'down', 'shoot'),
+                    range(first, first + len(ACTIONS))))
+
+
+class BatchInput(object):
+    """An input source that decides for lots of bots in one go.
+
+    Once every `every` ticks it calls ``controller(players, bullets)``
+    with structured arrays (PLAYER_DTYPE and BULLET_DTYPE) describing the
+    whole match. The controller returns an array of input masks, one per
+    player, with a bit set for each action held (JUMP, LEFT, RIGHT, DOWN
+    and SHOOT); they're held until the next decision. Bots only drive
+    players from `first` on, so people can have the first few.
+    """
+    def __init__(self, controller, every=1, first=0):
+        self.controller = controller
+        self.every = every
+        self.first = first
+        self.masks = None
+        self.keys = None
+        self.pressed_keys = {}
+
+    def observe(self, players):
+        table = numpy.zeros(len(players), PLAYER_DTYPE)
+        table['position'] = [tuple(p.body.position) for p in players]
+        table['velocity'] = [tuple(p.body.velocity) for p in players]
+        table['health'] = [p.health for p in players]
+        table['jumps'] = [p.remaining_jumps for p in players]
+
+        pool = players[0].bullets
+        live = numpy.flatnonzero(pool.active)
+        rows = dict((id(p), i) for i, p in enumerate(players))
+        bullets = numpy.zeros(len(live), BULLET_DTYPE)
+        bullets['position'] = pool.position[live]
+        bullets['velocity'] = pool.velocity[live]
+        bullets['owner'] = [rows[id(pool.owners[i])] for i in live.tolist()]
+        table['bullets'] = numpy.bincount(bullets['owner'],
+                                          minlength=len(players))
+        return table, bullets
+
+    def __call__(self, frame, players):
+        if self.masks is None or len(self.masks) != len(players) or \
+                frame % self.every == 0:
+            table, bullets = self.observe(players)
+            self.masks = numpy.asarray(self.controller(table, bullets),
+                                       numpy.uint8)
+        if self.keys is None or len(self.keys) != len(players) - self.first:
+            self.keys = numpy.array([[action_key(p, a) for a in ACTIONS]
+                                     for p in players[self.first:]],
+                                    numpy.int64)
+        # every bot's held bits, as a [bot, action] grid of booleans
+        bits = (self.masks[self.first:, None] >>
+                numpy.arange(len(ACTIONS))) & 1
+        held = set(self.keys[bits.astype(bool)].tolist())
+        return hold_counts(self.pressed_keys, held)
+
+
+class ChaseController(object):
+    """Sends every bot after its nearest living opponent, firing when
+    they're roughly level, all worked out at once with NumPy."""
+    def __init__(self, seed=None, jumpiness=.1):
+        self.rng = numpy.random.RandomState(seed)
+        self.jumpiness = jumpiness
+
+    def __call__(self, players, bullets):
+        count = len(players)
+        position = players['position']
+        alive = players['health'] > 0
+        # offset[i, j] is how far player j is from player i
+        offset = position[None, :, :] - position[:, None, :]
+        distance = numpy.hypot(offset[..., 0], offset[..., 1])
+        distance[:, ~alive] = numpy.inf
+        distance[numpy.arange(count), numpy.arange(count)] = numpy.inf
+        target = distance.argmin(axis=1)
+        has_target = numpy.isfinite(distance.min(axis=1)) & alive
+
+        dx, dy = offset[numpy.arange(count), target].T
+        masks = numpy.zeros(count, numpy.uint8)
+        masks[dx < -16] |= LEFT
+        masks[dx > 16] |= RIGHT
+        masks[(dy > 48) & (self.rng.random_sample(count) < self.jumpiness)] \
+            |= JUMP
+        masks[(abs(dy) < 48) & (abs(dx) < 400)] |= SHOOT
+        masks[~has_target] = 0
+        return masks
@@ -0,0 +1,166 @@
+"""Bullets, all of them at once.
+
+There are a lot of bullets and they don't live long, so rather than each
+being its own object with a body in the physics space, a match keeps every
+bullet in one set of preallocated arrays. Moving them is a single NumPy
+operation, and hits are found by tracing each bullet's path through the
+space with a segment query.
+"""
+import numpy
+import pygame
+import struct
+from game import PLAYER_COLLISION_TYPE
+from game.assets import ASSETS
+
+
+class BulletPool(object):
+    radius = 3
+    speed = 500
+    ttl = 40  # in ticks
+    cooldown = 10  # ticks between shots
+
+    def __init__(self, space, capacity=64):
+        self.space = space
+        self.position = numpy.zeros((capacity, 2))
+        self.previous_position = numpy.zeros((capacity, 2))
+        self.velocity = numpy.zeros((capacity, 2))
+        self.ttls = numpy.zeros(capacity, numpy.int32)
+        self.active = numpy.zeros(capacity, bool)
+        self.owners = [None] * capacity
+        self.free = list(range(capacity - 1, -1, -1))
+        self.shot_sound = ASSETS.sound("res/sfx/C_28P.ogg")
+
+    def __len__(self):
+        return int(self.active.sum())
+
+    def grow(self):
+        capacity = len(self.active)
+
+        def extend(a):
+            return numpy.concatenate((a, numpy.zeros_like(a)))
+        self.position = extend(self.position)
+        self.previous_position = extend(self.previous_position)
+        self.velocity = extend(self.velocity)
+        self.ttls = extend(self.ttls)
+        self.active = extend(self.active)
+        self.owners.extend([None] * capacity)
+        self.free.extend(range(2 * capacity - 1, capacity - 1, -1))
+
+    def fire(self, owner):
+        """Shoot a bullet out of the front of `owner`'s gun."""
+        if not self.free:
+            self.grow()
+        i = self.free.pop()
+
+        facing_left = owner.current_facing == owner.left_key
+        speed = -self.speed if facing_left else self.speed
+        offset = (0, -5) if facing_left else (20, -5)
+        position = owner.body.position
+        velocity = owner.body.velocity
+        self.position[i] = (position.x + offset[0], position.y + offset[1])
+        self.previous_position[i] = self.position[i]
+        self.velocity[i] = (velocity.x + speed, velocity.y)
+        self.ttls[i] = self.ttl
+        self.active[i] = True
+        self.owners[i] = owner
+        self.shot_sound.play()
+
+    def release(self, i):
+        self.active[i] = False
+        self.owners[i] = None
+        self.free.append(i)
+
+    def get_state(self, players):
+        """Every bullet slot as bytes, with owners saved as their index in
+        `players` (or -1 for a free slot). The free list is kept in order
+        too, so restored bullets get fired into the same slots."""
+        owners = numpy.array([-1 if o is None else players.index(o)
+                              for o in self.owners], '<i2')
+        return b''.join((
+            struct.pack('<II', len(owners), len(self.free)),
+            self.position.astype('<f8').tobytes(),
+            self.previous_position.astype('<f8').tobytes(),
+            self.velocity.astype('<f8').tobytes(),
+            self.ttls.astype('<i4').tobytes(),
+            owners.tobytes(),
+            numpy.array(self.free, '<i4').tobytes()))
+
+    def set_state(self, data, offset, players):
+        """Restore what get_state saved, starting `offset` bytes into
+        `data`. Returns the offset just past it."""
+        capacity, free = struct.unpack_from('<II', data, offset)
+        offset += 8
+        arrays = []
+        for dtype, shape in (('<f8', (capacity, 2)), ('<f8', (capacity, 2)),
+                             ('<f8', (capacity, 2)), ('<i4', capacity),
+                             ('<i2', capacity), ('<i4', free)):
+            a = numpy.frombuffer(data, dtype, numpy.prod(shape), offset)
+            arrays.append(a.reshape(shape).astype(dtype[1:]))
+            offset += a.nbytes
+        (self.position, self.previous_position, self.velocity, self.ttls,
+         owners, free) = arrays
+        self.active = owners >= 0
+        self.owners = [players[o] if o >= 0 else None for o in owners.tolist()]
+        self.free = free.tolist()
+        return offset
+
+    def step(self, dt):
+        """Move every bullet one tick, then resolve what they ran into."""
+        live = numpy.flatnonzero(self.active)
+        if not len(live):
+            return
+        self.previous_position[live] = self.position[live]
+        self.position[live] += self.velocity[live] * dt
+        self.ttls[live] -= 1
+
+        for i in live.tolist():
+            if self.ttls[i] < 0:
+                self.release(i)
+                continue
+            shape = self.first_hit(i)
+            if shape is None:
+                continue
+            if shape.collision_type == PLAYER_COLLISION_TYPE:
+                shape.body.player.take_damage(1, attacker=self.owners[i])
+            self.release(i)
+
+    def first_hit(self, i):
+        """The first shape along bullet `i`'s path this tick, not counting
+        whoever fired it."""
+        start = tuple(self.previous_position[i])
+        end = tuple(self.position[i])
+        owner_body = self.owners[i].body
+        hit, hit_t = None, None
+        for info in self.space.segment_query(start, end):
+            if info.shape.body is owner_body:
+                continue
+            if hit is None or info.t < hit_t:
+                hit, hit_t = info.shape, info.t
+        return hit
+
+    def view(self):
+        """Where the live bullets were the last two ticks, as copies."""
+        live = numpy.flatnonzero(self.active)
+        return self.previous_position[live], self.position[live]
+
+    def draw(self, screen, camera, alpha=1., scale=1):
+        return draw_bullets(screen, self.view(), camera, alpha, scale)
+
+
+def draw_bullets(screen, view, camera, alpha=1., scale=1):
+    """Draw the bullets in a BulletPool's view, returning how many were
+    drawn."""
+    previous, current = view
+    if not len(current):
+        return 0
+    # where each bullet is on screen, between the last two ticks
+    position = previous + (current - previous) * alpha
+    width, height = screen.get_size()
+    position -= (camera.x, camera.y)
+    position *= scale
+    position += (width / 2., height / 2.)
+    position[:, 1] = height - position[:, 1]
+    radius = max(int(round(BulletPool.radius * scale)), 1)
+    for x, y in position.astype(int).tolist():
+        pygame.draw.circle(screen, (0, 0, 0, 0), (x, y), radius)
+    return len(current)
@@ -0,0 +1,68 @@
+"""Keeping track of what players are standing on.
+
+Collision handlers are registered once per match and write straight into
+the players they involve: `touching` counts the shapes a player is in
+contact with, and on every step each contact from below sets `landed`,
+`ground_body`, `ground_slope`, `landed_hard` and `impact`. A player only
+has to read its own attributes to know where it stands, rather than
+walking its arbiters every tick.
+"""
+from game import PLAYER_COLLISION_TYPE, JUMP_THROUGH_COLLISION_TYPE
+
+GROUND_COLLISION_TYPE = 0  # what solid platforms have, being the default
+
+
+def begin_contact(space, arbiter):
+    a, b = arbiter.shapes
+    a.body.player.touching += 1
+    if b.collision_type == PLAYER_COLLISION_TYPE:
+        b.body.player.touching += 1
+    return True
+
+
+def begin_jump_through(space, arbiter):
+    begin_contact(space, arbiter)
+    # pass through only if going up
+    return arbiter.shapes[0].body.velocity.y < 0
+
+
+def separate_contact(space, arbiter):
+    a, b = arbiter.shapes
+    a.body.player.touching -= 1
+    if b.collision_type == PLAYER_COLLISION_TYPE:
+        b.body.player.touching -= 1
+
+
+def post_solve_contact(space, arbiter):
+    a, b = arbiter.shapes
+    normal = arbiter.contacts[0].normal
+    impulse = arbiter.total_impulse.y
+    _land(a.body.player, -normal, impulse, b.body)
+    if b.collision_type == PLAYER_COLLISION_TYPE:
+        # somebody might be standing on somebody else's head
+        _land(b.body.player, normal, -impulse, a.body)
+
+
+def _land(player, normal, impulse, ground):
+    if normal.y <= 0:
+        return  # not underneath
+    player.landed = True
+    player.ground_body = ground
+    player.ground_slope = normal.x / normal.y
+    landing_speed = impulse / player.body.mass
+    player.landed_hard = landing_speed > 100
+    player.impact = max(player.impact, landing_speed)
+
+
+def track_contacts(space):
+    """Register the handlers for players touching anything in `space`."""
+    space.add_collision_handler(
+        PLAYER_COLLISION_TYPE, GROUND_COLLISION_TYPE, begin=begin_contact,
+        post_solve=post_solve_contact, separate=separate_contact)
+    space.add_collision_handler(
+        PLAYER_COLLISION_TYPE, PLAYER_COLLISION_TYPE, begin=begin_contact,
+        post_solve=post_solve_contact, separate=separate_contact)
+    space.add_collision_handler(
+        PLAYER_COLLISION_TYPE, JUMP_THROUGH_COLLISION_TYPE,
+        begin=begin_jump_through, post_solve=post_solve_contact,
+        separate=separate_contact)
@@ -0,0 +1,183 @@
+"""Turning keyboards, gamepads and anything else into players' actions.
+
+Every player has five actions: jump, left, right, down and shoot. The
+simulation still takes the same ``key -> ticks held`` mapping it always
+has, keyed by each player's own key for the action, so bots, replays and
+the network code don't have to know where input came from.
+
+Rather than scanning the whole keyboard every tick, Controls only
+listens to events and only keeps track of bound inputs that are actually
+held, so a tick costs as much as the events that came in and the buttons
+being pressed.
+"""
+import pygame
+from pygame import locals as KEYS
+from game.replay import hold_counts
+
+ACTIONS = ('jump', 'left', 'right', 'down', 'shoot')
+
+# How a gamepad maps to actions, by SDL's usual numbering: A jumps, B and
+# X shoot, and the left stick or d-pad moves
+GAMEPAD = {
+    ('button', 0): 'jump',
+    ('button', 1): 'shoot',
+    ('button', 2): 'shoot',
+    ('axis', 0, -1): 'left',
+    ('axis', 0, 1): 'right',
+    ('axis', 1, 1): 'down',
+    ('hat', 0, -1): 'left',
+    ('hat', 0, 1): 'right',
+    ('hat', 1, -1): 'down',
+    ('hat', 1, 1): 'jump',
+}
+DEAD_ZONE = .5  # how far a stick has to be pushed to count
+
+
+def action_key(player, action):
+    """The key `player` looks for in pressed keys to do `action`."""
+    return getattr(player, action + '_key')
+
+
+def input_mask(player, pressed_keys):
+    """Pack which of `player`'s actions are held into a byte, one bit per
+    action in ACTIONS order."""
+    mask = 0
+    for bit, action in enumerate(ACTIONS):
+        if action_key(player, action) in pressed_keys:
+            mask |= 1 << bit
+    return mask
+
+
+def keys_held(players, masks):
+    """The set of keys that `masks` says each of `players` is holding."""
+    return set(action_key(player, action)
+               for player, mask in zip(players, masks)
+               for bit, action in enumerate(ACTIONS) if mask >> bit & 1)
+
+
+class Controls(object):
+    """An input source that drives players from real devices.
+
+    Bind each player's keys and gamepad, call `poll` to handle this
+    tick's events, then call it like any other input source
+    (``controls(frame, players)``) for the pressed keys. Other input
+    sources added with `add_source` are merged in, so bots or a replay
+    can play alongside people, or instead of them.
+    """
+    def __init__(self):
+        self.bindings = {}  # physical input -> keys it holds down
+        self.held = {}  # key -> physical inputs holding it
+        self.tapped = set()  # keys that went down since the last tick
+        self.pressed_keys = {}
+        self.released = set()
+        self.went_down = set()  # every keyboard key pressed this tick
+        self.sources = []
+        self.pads = {}  # joystick instance id -> device index
+        self.joysticks = []
+        self.quit = False
+
+    def bind(self, physical, key):
+        self.bindings.setdefault(physical, []).append(key)
+
+    def bind_keys(self, player):
+        """Let `player` be played on the keyboard with their own keys."""
+        for action in ACTIONS:
+            key = action_key(player, action)
+            if key is not None:
+                self.bind(('key', key), key)
+
+    def bind_gamepad(self, player, pad, layout=GAMEPAD):
+        """Let `player` be played with gamepad number `pad`."""
+        if not pygame.joystick.get_init():
+            pygame.joystick.init()
+        if pad < pygame.joystick.get_count():
+            self.open_pad(pad)
+        for control, action in layout.items():
+            self.bind((control[0], pad) + control[1:],
+                      action_key(player, action))
+
+    def open_pad(self, index):
+        joystick = pygame.joystick.Joystick(index)
+        joystick.init()
+        self.joysticks.append(joystick)  # closes if garbage collected
+        if hasattr(joystick, 'get_instance_id'):
+            self.pads[joystick.get_instance_id()] = index
+
+    def add_source(self, source):
+        """Also hold whatever keys ``source(frame, players)`` returns."""
+        self.sources.append(source)
+
+    def pressed(self, player, action):
+        """Whether `action` started this tick."""
+        return self.pressed_keys.get(action_key(player, action)) == 1
+
+    def holding(self, player, action):
+        """How many ticks `action` has been held, 0 if it isn't."""
+        return self.pressed_keys.get(action_key(player, action), 0)
+
+    def stopped(self, player, action):
+        """Whether `action` ended this tick."""
+        return action_key(player, action) in self.released
+
+    def poll(self):
+        """Handle every event waiting since the last tick."""
+        self.went_down.clear()
+        for event in pygame.event.get():
+            self.handle(event)
+
+    def handle(self, event):
+        kind = event.type
+        if kind == KEYS.QUIT:
+            self.quit = True
+        elif kind == KEYS.KEYDOWN:
+            self.went_down.add(event.key)
+            if event.key == KEYS.K_ESCAPE:
+                self.quit = True
+            self.hold(('key', event.key), True)
+        elif kind == KEYS.KEYUP:
+            self.hold(('key', event.key), False)
+        elif kind in (KEYS.JOYBUTTONDOWN, KEYS.JOYBUTTONUP):
+            self.hold(('button', self.pad(event), event.button),
+                      kind == KEYS.JOYBUTTONDOWN)
+        elif kind == KEYS.JOYAXISMOTION:
+            pad = self.pad(event)
+            for sign in (-1, 1):
+                self.hold(('axis', pad, event.axis, sign),
+                          event.value * sign > DEAD_ZONE)
+        elif kind == KEYS.JOYHATMOTION:
+            pad = self.pad(event)
+            for axis, value in enumerate(event.value):
+                for sign in (-1, 1):
+                    self.hold(('hat', pad, axis, sign), value == sign)
+        elif kind == getattr(KEYS, 'JOYDEVICEADDED', None):
+            self.open_pad(event.device_index)
+        elif kind == KEYS.ACTIVEEVENT and not event.gain and event.state & 2:
+            # lost keyboard focus, so we'll never hear about keys going up
+            self.held.clear()
+
+    def pad(self, event):
+        if hasattr(event, 'instance_id'):
+            return self.pads.get(event.instance_id, event.instance_id)
+        return event.joy
+
+    def hold(self, physical, down):
+        for key in self.bindings.get(physical, ()):
+            holders = self.held.setdefault(key, set())
+            if down:
+                holders.add(physical)
+                self.tapped.add(key)
+            else:
+                holders.discard(physical)
+                if not holders:
+                    del self.held[key]
+
+    def __call__(self, frame=None, players=None):
+        # a key that went down and up again between ticks still counts
+        # as pressed for one tick
+        held = set(self.held)
+        held.update(self.tapped)
+        self.tapped.clear()
+        for source in self.sources:
+            held.update(source(frame, players))
+        self.released = set(self.pressed_keys).difference(held)
+        return hold_counts(self.pressed_keys, held)
@@ -0,0 +1,57 @@
+"""Only drawing what the camera can see.
+
+In an arena bigger than the screen most players and bullets are off it,
+and drawing them is wasted. Each tick that gets drawn, their positions
+are bucketed into a grid once; drawing then asks the grid for what's in
+the box the camera sees, plus a margin for sprites that stick out past
+their position and for movement between ticks.
+
+Culling only skips drawing. Animations are advanced by the simulation,
+so a cat that walks back on screen is on the right frame.
+"""
+import numpy
+
+CELL = 256  # px on a side of each grid cell
+MARGIN = 128  # px past the edges of the screen to draw things in
+# cell rows go in the low half of a key, offset so negative rows sort
+# below positive ones
+_ROWS = 1 << 32
+
+
+class GridIndex(object):
+    """Points bucketed into square cells, for finding the ones in a box
+    without looking at every one."""
+    def __init__(self, positions, cell=CELL):
+        positions = numpy.asarray(positions, float).reshape(-1, 2)
+        self.cell = cell
+        cells = numpy.floor(positions / cell).astype(numpy.int64)
+        keys = cells[:, 0] * _ROWS + cells[:, 1] + _ROWS // 2
+        self.order = numpy.argsort(keys, kind='stable')
+        self.keys = keys[self.order]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def query(self, left, bottom, right, top):
+        """Indices, in order, of the points in the cells the box touches."""
+        cell = self.cell
+        columns = numpy.arange(int(left // cell), int(right // cell) + 1,
+                               dtype=numpy.int64) * _ROWS + _ROWS // 2
+        starts = numpy.searchsorted(self.keys, columns + int(bottom // cell))
+        ends = numpy.searchsorted(self.keys, columns + int(top // cell),
+                                  'right')
+        found = [self.order[start:end]
+                 for start, end in zip(starts.tolist(), ends.tolist())
+                 if end > start]
+        if not found:
+            return numpy.zeros(0, numpy.intp)
+        return numpy.sort(numpy.concatenate(found))
+
+
+def visible_box(camera, size, scale=1, margin=MARGIN):
+    """The ``(left, bottom, right, top)`` box of the level a screen `size`
+    px across shows around `camera` at `scale`, plus `margin`."""
+    half_width = size[0] / 2. / scale + margin
+    half_height = size[1] / 2. / scale + margin
+    return (camera.x - half_width, camera.y - half_height,
+            camera.x + half_width, camera.y + half_height)
@@ -0,0 +1,162 @@
+"""Tidying up a level's collision geometry before it goes in the space.
+
+Levels are drawn by hand in Tiled, so their polylines are full of points
+that don't need to be there: doubled-up points, points in the middle of
+what's really a straight line, and lines that carry straight on from
+another line. Every edge is a shape the physics has to consider, so
+`optimize` boils them down to as few segments as it can, and
+`tune_spatial_hash` picks broadphase settings to suit what's left.
+"""
+import math
+from collections import namedtuple
+
+import pymunk
+
+from game.level import PlatformInfo
+
+TOLERANCE = 1.  # px a point can be off a line and still count as on it
+
+# An axis-aligned box of solid ground, from (left, bottom) to (right, top)
+Box = namedtuple('Box', 'left bottom right top')
+
+
+def simplify(points, tolerance=TOLERANCE):
+    """`points` without repeats, or points that sit on the straight line
+    between their neighbours."""
+    kept = []
+    for point in points:
+        if kept and math.hypot(point[0] - kept[-1][0],
+                               point[1] - kept[-1][1]) <= tolerance:
+            continue  # degenerate edge
+        while len(kept) >= 2 and _between(kept[-2], kept[-1], point,
+                                           tolerance):
+            kept.pop()
+        kept.append(point)
+    return kept
+
+
+def _between(a, b, c, tolerance):
+    """Whether b is on the line from a to c, and between them."""
+    dx, dy = c[0] - a[0], c[1] - a[1]
+    length = math.hypot(dx, dy)
+    if not length:
+        return False
+    off_line = abs(dx * (b[1] - a[1]) - dy * (b[0] - a[0])) / length
+    along = (dx * (b[0] - a[0]) + dy * (b[1] - a[1])) / length
+    return off_line <= tolerance and 0 <= along <= length
+
+
+def as_box(points, tile_size):
+    """The Box a closed, tile-aligned rectangle of `points` outlines, or
+    None if that's not what it is."""
+    if len(points) != 5 or tuple(points[0]) != tuple(points[-1]):
+        return None
+    xs = sorted(set(p[0] for p in points))
+    ys = sorted(set(p[1] for p in points))
+    if len(xs) != 2 or len(ys) != 2:
+        return None
+    for a, b in zip(points, points[1:]):
+        if a[0] != b[0] and a[1] != b[1]:
+            return None  # diagonal
+    if any(x % tile_size[0] for x in xs) or any(y % tile_size[1] for y in ys):
+        return None
+    return Box(xs[0], ys[0], xs[1], ys[1])
+
+
+def merge_segments(segments, tolerance=TOLERANCE):
+    """Join up segments that lie along the same line and overlap or
+    touch. Returns the merged ``(start, end)`` pairs."""
+    lines = {}
+    for a, b in segments:
+        dx, dy = b[0] - a[0], b[1] - a[1]
+        length = math.hypot(dx, dy)
+        ux, uy = dx / length, dy / length
+        if ux < 0 or (ux == 0 and uy < 0):
+            ux, uy = -ux, -uy
+        # the same line always gets the same direction, and the same
+        # distance from the origin along its normal
+        offset = a[1] * ux - a[0] * uy
+        key = (round(ux, 3), round(uy, 3), round(offset / tolerance))
+        t0 = a[0] * ux + a[1] * uy
+        t1 = b[0] * ux + b[1] * uy
+        lines.setdefault(key, (ux, uy, offset, []))[3].append(
+            (min(t0, t1), max(t0, t1)))
+
+    merged = []
+    for ux, uy, offset, spans in lines.values():
+        spans.sort()
+        start, end = spans[0]
+        for t0, t1 in spans[1:]:
+            if t0 <= end + tolerance:
+                end = max(end, t1)
+            else:
+                merged.append(_span(ux, uy, offset, start, end))
+                start, end = t0, t1
+        merged.append(_span(ux, uy, offset, start, end))
+    return merged
+
+
+def _span(ux, uy, offset, t0, t1):
+    # back from distances along the line to points on it
+    return ((t0 * ux - offset * uy, t0 * uy + offset * ux),
+            (t1 * ux - offset * uy, t1 * uy + offset * ux))
+
+
+def optimize(platforms, tile_size, boxes=False):
+    """Boil a level's PlatformInfos down to as few shapes as possible.
+
+    Returns ``(platforms, boxes)``. Moving platforms are only simplified;
+    static ones are broken into single segments so that lines carrying
+    on from each other can be merged. With `boxes`, closed tile-aligned
+    rectangles come back as Boxes rather than four segments each.
+    """
+    optimized = []
+    found = []
+    segments = {False: [], True: []}  # by jump_through
+    for info in platforms:
+        points = simplify(info.points)
+        if info.waypoints:
+            if len(points) >= 2:
+                info = info._replace(points=points)
+            optimized.append(info)
+            continue
+        box = as_box(info.points, tile_size) if boxes else None
+        if box is not None and not info.jump_through:
+            found.append(box)
+            continue
+        segments[info.jump_through].extend(zip(points, points[1:]))
+
+    for jump_through, edges in sorted(segments.items()):
+        if not edges:
+            continue
+        for a, b in merge_segments(edges):
+            optimized.append(PlatformInfo((a, b), jump_through, 1, ()))
+    return optimized, found
+
+
+def tune_spatial_hash(space, size, extents):
+    """Switch `space` to a spatial hash sized for a level `size` px across
+    full of shapes `extents` px across.
+
+    Cells about as big as a typical shape keep each shape in only a few
+    cells without crowding many into one. There's a bucket for every
+    cell the level covers, up to ten per shape, but never fewer than
+    1000, as moving things can end up in cells all over the place.
+
+    pymunk 4 doesn't wrap Chipmunk's cpSpaceUseSpatialHash, so it's
+    called directly; a pymunk without it keeps its default broadphase.
+    Returns ``(dim, count)``, or None if the space wasn't changed.
+    """
+    extents = sorted(extents)
+    dim = extents[len(extents) // 2] if extents else 32
+    dim = max(dim, 32)  # no smaller than a cat
+    cells = int(math.ceil(size[0] / dim) * math.ceil(size[1] / dim))
+    count = max(1000, min(cells, 10 * len(extents)))
+    chipmunk = getattr(pymunk, '_chipmunk', None)
+    if hasattr(space, 'use_spatial_hash'):
+        space.use_spatial_hash(dim, count)
+    elif hasattr(chipmunk, 'cpSpaceUseSpatialHash'):
+        chipmunk.cpSpaceUseSpatialHash(space._space, dim, count)
+    else:
+        return None
+    return dim, count
@@ -0,0 +1,57 @@
+"""Picking up changes to a level while the game is running.
+
+Save the level in Tiled and the running match changes to match within a
+frame or so: only the chunks of tiles that changed get drawn again, and
+only the platforms that changed go in or out of the physics space.
+Everything else, players and bullets and the camera included, carries on
+where it was.
+
+Moving platforms can come and go, so snapshots taken before a reload
+might not fit the match after it; this is for editing levels, not for
+replays or online play.
+"""
+import os
+import sys
+import time
+from xml.etree.ElementTree import ParseError
+
+from game.level import load_level
+
+
+class LevelWatcher(object):
+    """Checks a level file for changes every `interval` seconds, and
+    reloads a TileWorld from it when there are some."""
+    def __init__(self, world, filename, interval=.5):
+        self.world = world
+        self.filename = filename
+        self.interval = interval
+        self.mtime = self.modified()
+        self.next_check = time.time() + interval
+
+    def modified(self):
+        try:
+            return os.path.getmtime(self.filename)
+        except OSError:
+            return None  # in the middle of being saved, perhaps
+
+    def poll(self):
+        """Reload the level if it's changed since last time. Returns how
+        many chunks and platforms changed, or None if nothing did."""
+        now = time.time()
+        if now < self.next_check:
+            return None
+        self.next_check = now + self.interval
+        mtime = self.modified()
+        if mtime is None or mtime == self.mtime:
+            return None
+        self.mtime = mtime
+        try:
+            level = load_level(self.filename)
+        except (OSError, ParseError, ValueError, TypeError, AttributeError,
+                KeyError) as e:
+            # gone for a moment, half saved, or just broken; try again
+            # when it's saved next
+            sys.stderr.write("Couldn't reload {}: {}\n".format(
+                self.filename, e))
+            return None
+        return self.world.reload(level)
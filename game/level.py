@@ -0,0 +1,187 @@
+"""Level loading, from Tiled's TMX files or our own compiled version of them.
+
+Parsing the XML and all those CSV strings is slow, so a level can be
+compiled ahead of time into a binary file next to it:
+
+    python -m game.level levels/level.tmx
+
+`load_level` picks up the compiled file whenever it is newer than the TMX,
+and quietly goes back to parsing the TMX when it isn't.
+"""
+import mmap
+import os
+import struct
+import sys
+from collections import namedtuple
+from xml.etree import ElementTree
+
+import numpy
+
+MAGIC = b'CATL'
+VERSION = 1
+HEADER = struct.Struct('<4sHHHHHHI')
+TILE_DTYPE = numpy.dtype('<u2')
+PLATFORM = struct.Struct('<BxxxiII')  # jump_through, speed, points, waypoints
+POINT = struct.Struct('<dd')
+
+PlatformInfo = namedtuple('PlatformInfo',
+                          'points jump_through speed waypoints')
+
+
+class Level(object):
+    """Everything a TileWorld needs to know about a map.
+
+    Each layer is a 2d array of tile ids indexed by [row, column], with the
+    top row first, the same way round as Tiled and pygame.
+    """
+    def __init__(self, width, height, tile_width, tile_height, layers,
+                 platforms):
+        self.width = width
+        self.height = height
+        self.tile_width = tile_width
+        self.tile_height = tile_height
+        self.layers = layers
+        self.platforms = platforms
+
+
+def compiled_filename(filename):
+    return os.path.splitext(filename)[0] + '.lvl'
+
+
+def pointify(csv_string, map_height, group_offset=(0, 0)):
+    if group_offset[1]:
+        offset = map_height - group_offset[1]
+    else:
+        offset = 0
+    point_strings = [p.split(',') for p in csv_string.split()]
+    return tuple((group_offset[0] + int(p[0]), offset - int(p[1]))
+                 for p in point_strings)
+
+
+def parse_tmx(filename):
+    root = ElementTree.parse(filename).getroot()
+    width, height = int(root.get('width')), int(root.get('height'))
+    tile_width = int(root.get('tilewidth'))
+    tile_height = int(root.get('tileheight'))
+    map_height = tile_height * height
+
+    layers = []
+    for layer in root.findall('layer'):
+        # This is the csv of the map data, one row of tile ids per line
+        csv = layer.findall('data')[0].text
+        tiles = [int(t) for t in csv.replace('\n', '').split(',') if t]
+        if len(tiles) != width * height:
+            raise ValueError("{}: layer {!r} has {} tiles, expected {}".format(
+                filename, layer.get('name'), len(tiles), width * height))
+        if max(tiles) > 0xffff:
+            raise ValueError("{}: layer {!r} uses flipped tiles, which "
+                             "aren't supported".format(filename,
+                                                       layer.get('name')))
+        layers.append(
+            numpy.array(tiles, dtype=TILE_DTYPE).reshape(height, width))
+
+    # These are the collision objects
+    platforms = []
+    for object_group in root.findall('objectgroup'):
+        for obj in object_group.iter('object'):
+            jump_through = False
+            speed = 1
+            waypoints = ()
+            group_offset = (int(obj.get('x')), int(obj.get('y')))
+            for p in obj.iter('property'):
+                if p.get('name') == "jump_through":
+                    jump_through = True
+                if p.get('name') == "speed":
+                    speed = int(p.get('value'))
+                if p.get('name') == "waypoints":
+                    waypoints = pointify(p.get('value'), map_height)
+            line = obj.find('polyline')
+            points = pointify(line.get('points'), map_height,
+                              group_offset=group_offset)
+            platforms.append(
+                PlatformInfo(points, jump_through, speed, waypoints))
+
+    return Level(width, height, tile_width, tile_height, layers, platforms)
+
+
+def compile_level(filename, output=None):
+    """Write the compiled version of a TMX file, returning its name."""
+    level = parse_tmx(filename)
+    output = output or compiled_filename(filename)
+    chunks = [HEADER.pack(MAGIC, VERSION, level.width, level.height,
+                          level.tile_width, level.tile_height,
+                          len(level.layers), len(level.platforms))]
+    for layer in level.layers:
+        chunks.append(numpy.ascontiguousarray(layer, TILE_DTYPE).tobytes())
+    for p in level.platforms:
+        chunks.append(PLATFORM.pack(p.jump_through, p.speed,
+                                    len(p.points), len(p.waypoints)))
+        chunks.extend(POINT.pack(*point) for point in p.points)
+        chunks.extend(POINT.pack(*point) for point in p.waypoints)
+
+    # write then rename, so a running game never sees half a file
+    temp = output + '.tmp'
+    with open(temp, 'wb') as f:
+        f.write(b''.join(chunks))
+    os.replace(temp, output)
+    return output
+
+
+def _read_points(data, offset, count):
+    points = tuple(POINT.unpack_from(data, offset + i * POINT.size)
+                   for i in range(count))
+    return points, offset + count * POINT.size
+
+
+def read_compiled(filename):
+    """Load a compiled level, with the tile layers mapped straight from
+    the file rather than copied into memory."""
+    with open(filename, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    (magic, version, width, height, tile_width, tile_height, layer_count,
+     platform_count) = HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("{} is not a version {} compiled level".format(
+            filename, VERSION))
+    offset = HEADER.size
+
+    layers = []
+    layer_bytes = width * height * TILE_DTYPE.itemsize
+    for _ in range(layer_count):
+        if offset + layer_bytes > len(data):
+            raise ValueError("{} is truncated".format(filename))
+        layer = numpy.frombuffer(data, TILE_DTYPE, width * height, offset)
+        layers.append(layer.reshape(height, width))
+        offset += layer_bytes
+
+    platforms = []
+    for _ in range(platform_count):
+        jump_through, speed, point_count, waypoint_count = \
+            PLATFORM.unpack_from(data, offset)
+        offset += PLATFORM.size
+        points, offset = _read_points(data, offset, point_count)
+        waypoints, offset = _read_points(data, offset, waypoint_count)
+        platforms.append(
+            PlatformInfo(points, bool(jump_through), speed, waypoints))
+
+    return Level(width, height, tile_width, tile_height, layers, platforms)
+
+
+def load_level(filename):
+    """Load a level, using the compiled version of it if it's up to date."""
+    compiled = compiled_filename(filename)
+    try:
+        fresh = os.path.getmtime(compiled) >= os.path.getmtime(filename)
+    except OSError:
+        fresh = False
+    if fresh:
+        try:
+            return read_compiled(compiled)
+        except (ValueError, struct.error):
+            pass  # stale format or a broken file, the TMX will do
+    return parse_tmx(filename)
+
+
+if __name__ == '__main__':
+    for name in sys.argv[1:]:
+        print("{} -> {}".format(name, compile_level(name)))
@@ -0,0 +1,171 @@
+"""A match bundles everything one game needs: its own physics space, level
+and players. Matches don't share anything, so any number of them can run
+side by side in the same process."""
+import struct
+import zlib
+from collections import namedtuple
+
+import pymunk
+from pymunk import Vec2d
+from game import GRAVITY
+from game.bullets import BulletPool, draw_bullets
+from game.contacts import track_contacts
+from game.culling import GridIndex, visible_box
+from game.player import Player, draw_player
+from game.profiler import NullProfiler
+from game.world import TileWorld
+
+# A copy of everything that gets drawn, as of the end of tick `frame`, and
+# GridIndexes of where the players and bullets are
+MatchView = namedtuple('MatchView', 'frame previous_camera camera players '
+                       'bullets player_index bullet_index')
+
+
+class Match(object):
+    # frame, camera, previous camera, player count, moving platform count
+    SNAPSHOT_HEADER = struct.Struct('<I4dHH')
+
+    def __init__(self, level, render=True, boxes=False):
+        self.space = pymunk.Space()
+        self.space.gravity = GRAVITY
+        track_contacts(self.space)
+
+        self.world = TileWorld(self.space, level, render=render, boxes=boxes)
+        self.bullets = BulletPool(self.space)
+        self.players = []
+        self.frame = 0
+        self.profiler = NullProfiler()
+        self.index = None  # where things are for culling, once drawn
+
+    def add_player(self, name, img, **keys):
+        player = Player(self.space, self.bullets, name, img, **keys)
+        self.players.append(player)
+        self.index = None
+        return player
+
+    def step(self, pressed_keys, dt):
+        """Advance the simulation by exactly one fixed tick."""
+        profiler = self.profiler
+        for player in self.players:
+            player.prepare_step()
+        with profiler.phase("physics"):
+            self.world.stream(self.players)
+            self.space.step(dt)
+        with profiler.phase("bullets"):
+            self.bullets.step(dt)
+        with profiler.phase("world"):
+            self.world.update(dt, self.players)
+        with profiler.phase("players"):
+            for player in self.players:
+                player.update(pressed_keys)
+        self.frame += 1
+        self.index = None
+
+        if profiler.enabled:
+            bullets = len(self.bullets)
+            profiler.count("shapes", len(self.space.shapes))
+            profiler.count("players", len(self.players))
+            profiler.count("bullets", bullets)
+            profiler.count("entities", len(self.players) + bullets +
+                           len(self.world.moving))
+            profiler.count("contacts", self.count_contacts())
+
+    def snapshot(self):
+        """Pack the whole simulation state into a compact bytes object.
+
+        This is everything our own code keeps track of. pymunk's internal
+        contact caches aren't included, so stepping on from a restored
+        snapshot can come out very slightly differently from stepping on
+        from the original.
+        """
+        world = self.world
+        moving = world.moving
+        chunks = [self.SNAPSHOT_HEADER.pack(
+            self.frame, world.camera.x, world.camera.y,
+            world.previous_camera.x, world.previous_camera.y,
+            len(self.players), len(moving))]
+        chunks.extend(p.STATE.pack(*p.get_state()) for p in self.players)
+        chunks.extend(p.STATE.pack(*p.get_state()) for p in moving)
+        chunks.append(self.bullets.get_state(self.players))
+        return b''.join(chunks)
+
+    def restore(self, snapshot):
+        """Put the match back the way it was when `snapshot` was taken."""
+        world = self.world
+        moving = world.moving
+        (self.frame, cx, cy, px, py, player_count,
+         platform_count) = self.SNAPSHOT_HEADER.unpack_from(snapshot)
+        if player_count != len(self.players) or \
+                platform_count != len(moving):
+            raise ValueError("snapshot is from a different match")
+        world.camera = Vec2d(cx, cy)
+        world.previous_camera = Vec2d(px, py)
+        offset = self.SNAPSHOT_HEADER.size
+        for entity in self.players + moving:
+            entity.set_state(entity.STATE.unpack_from(snapshot, offset))
+            offset += entity.STATE.size
+        self.bullets.set_state(snapshot, offset, self.players)
+        world.restored(self.frame, self.players)
+        self.index = None
+
+    def state_hash(self):
+        """A checksum of the simulation state, for spotting desyncs."""
+        state = [(tuple(p.body.position), tuple(p.body.velocity), p.health,
+                  p.remaining_jumps, p.shot_cooldown) for p in self.players]
+        state.append((self.frame, tuple(self.world.camera)))
+        h = zlib.crc32(repr(state).encode('utf-8'))
+        live = self.bullets.active
+        h = zlib.crc32(self.bullets.position[live].tobytes(), h)
+        return h & 0xffffffff
+
+    def count_contacts(self):
+        """How many shapes are touching players, counted once per player
+        touching them. pymunk won't list every arbiter, but these are the
+        ones that cost us anything in Python."""
+        return sum(p.touching for p in self.players)
+
+    def view(self):
+        """Copy out what `draw_view` needs, so it can be drawn while the
+        match goes on."""
+        world = self.world
+        players = [p.view() for p in self.players]
+        bullets = self.bullets.view()
+        if self.index is None:
+            # at most once a tick, however many frames draw it
+            self.index = (GridIndex([tuple(p.position) for p in players]),
+                          GridIndex(bullets[1]))
+        return MatchView(self.frame, Vec2d(world.previous_camera),
+                         Vec2d(world.camera), players, bullets, *self.index)
+
+    def draw(self, screen, alpha=1., scale=1):
+        """Draw the match `alpha` of the way between the last two ticks,
+        with everything `scale` times its full size."""
+        self.draw_view(screen, self.view(), alpha, scale)
+
+    def draw_view(self, screen, view, alpha=1., scale=1, profiler=None):
+        """Draw a MatchView, skipping players and bullets off screen. Only
+        the level's tiles come from the match itself, and those only change
+        when the level is reloaded, which draws the changed chunks again.
+        Timings go to `profiler`, if not the match's own."""
+        if profiler is None:
+            profiler = self.profiler
+        camera = view.previous_camera.interpolate_to(view.camera, alpha)
+        with profiler.phase("draw world"):
+            screen.fill((54, 54, 54, 255))  # Dark gray color
+            blits = self.world.draw(screen, camera, scale)
+        with profiler.phase("draw players"):
+            box = visible_box(camera, screen.get_size(), scale)
+            players = view.player_index.query(*box)
+            for i in players.tolist():
+                blits += draw_player(screen, view.players[i], camera, alpha,
+                                     scale)
+            bullets = view.bullet_index.query(*box)
+            previous, current = view.bullets
+            blits += draw_bullets(screen, (previous[bullets],
+                                           current[bullets]),
+                                  camera, alpha, scale)
+        profiler.count("blits", blits)
+        profiler.count("culled", len(view.players) - len(players) +
+                       len(current) - len(bullets))
+        #import pymunk.pygame_util
+        #pymunk.pygame_util.draw(screen, self.space)  # TODO: camera support
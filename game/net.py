@@ -0,0 +1,417 @@
+"""Playing over the network.
+
+The server runs the one true simulation. Clients only ever send it their
+inputs: one byte per tick saying which of jump, left, right, down and
+shoot are held. The server sends back a snapshot of the match every few
+ticks.
+
+Snapshots are quantized (floats become fixed point ints) and then
+XORed against the last snapshot the client told us it has, so anything
+that didn't change is all zero bytes and compresses to almost nothing.
+
+Meanwhile each client runs the simulation itself with its own inputs
+applied straight away, so its cat moves the moment a key goes down. When
+a snapshot arrives it rolls back to it and re-simulates the inputs the
+server hasn't seen yet.
+
+Everything goes over UDP, and both ends can add fake latency, jitter and
+packet loss to their sends for testing over localhost.
+"""
+import asyncio
+import random
+import re
+import struct
+import zlib
+from collections import OrderedDict, deque
+
+import numpy
+from game.controls import keys_held
+from game.player import Player
+from game.replay import hold_counts
+from game.world import Platform
+
+VERSION = 2
+HELLO, WELCOME, INPUT, SNAPSHOT = range(4)
+HELLO_PACKET = struct.Struct('<BB')  # kind, version
+# kind, version, slot, frame, player count
+WELCOME_PACKET = struct.Struct('<BBBIH')
+# kind, acked snapshot frame, first input sequence number, input count
+INPUT_PACKET = struct.Struct('<BIIB')
+# kind, frame, frame it's a delta against, last input sequence applied
+SNAPSHOT_PACKET = struct.Struct('<BIII')
+NO_BASE = 0xffffffff
+
+# frame, player count, moving platform count
+STATE_HEADER = struct.Struct('<IHH')
+SCALE = 256.  # fixed point positions are good to 1/256 px
+HISTORY = 64  # snapshots kept around as delta bases
+REDUNDANCY = 16  # inputs resent in every input packet, to ride out loss
+TIMEOUT = 5.  # seconds of silence before the server forgets a client
+
+
+def _xor(a, b):
+    return numpy.bitwise_xor(numpy.frombuffer(a, numpy.uint8),
+                             numpy.frombuffer(b, numpy.uint8)).tobytes()
+
+
+class _Quantized(object):
+    """A struct layout with every double swapped for a fixed point int."""
+    def __init__(self, exact):
+        self.exact = exact
+        fmt = exact.format
+        if not isinstance(fmt, str):
+            fmt = fmt.decode('ascii')
+        codes = []
+        for count, code in re.findall(r'(\d*)(\D)', fmt[1:]):
+            codes.extend(code * int(count or 1))
+        self.floats = [i for i, code in enumerate(codes) if code == 'd']
+        self.struct = struct.Struct(fmt.replace('d', 'i'))
+
+    def quantize(self, data, offset, out):
+        values = list(self.exact.unpack_from(data, offset))
+        for i in self.floats:
+            values[i] = int(round(values[i] * SCALE))
+        out.append(self.struct.pack(*values))
+        return offset + self.exact.size
+
+    def dequantize(self, data, offset, out):
+        values = list(self.struct.unpack_from(data, offset))
+        for i in self.floats:
+            values[i] /= SCALE
+        out.append(self.exact.pack(*values))
+        return offset + self.struct.size
+
+
+PLAYER_STATE = _Quantized(Player.STATE)
+PLATFORM_STATE = _Quantized(Platform.STATE)
+
+
+def encode_state(match, masks):
+    """The match's state, and everyone's inputs, in network form.
+
+    This is Match.snapshot() with the camera left out (that's up to each
+    client) and every float quantized.
+    """
+    snapshot = match.snapshot()
+    (frame, _, _, _, _, player_count,
+     platform_count) = match.SNAPSHOT_HEADER.unpack_from(snapshot)
+    out = [STATE_HEADER.pack(frame, player_count, platform_count),
+           bytes(bytearray(masks))]
+    offset = match.SNAPSHOT_HEADER.size
+    for _ in range(player_count):
+        offset = PLAYER_STATE.quantize(snapshot, offset, out)
+    for _ in range(platform_count):
+        offset = PLATFORM_STATE.quantize(snapshot, offset, out)
+
+    # bullets: positions and velocities go to fixed point too
+    capacity, free = struct.unpack_from('<II', snapshot, offset)
+    out.append(snapshot[offset:offset + 8])
+    offset += 8
+    floats = numpy.frombuffer(snapshot, '<f8', capacity * 6, offset)
+    out.append(numpy.round(floats * SCALE).astype('<i4').tobytes())
+    offset += floats.nbytes
+    out.append(snapshot[offset:])  # ttls, owners and the free list
+    return b''.join(out)
+
+
+def decode_state(state, match):
+    """Turn what encode_state made back into a ``(snapshot, masks)`` pair,
+    where `snapshot` can be passed to `match.restore`. The camera is left
+    where `match` has it."""
+    frame, player_count, platform_count = STATE_HEADER.unpack_from(state)
+    offset = STATE_HEADER.size
+    masks = list(bytearray(state[offset:offset + player_count]))
+    offset += player_count
+
+    camera = match.world.camera
+    previous = match.world.previous_camera
+    out = [match.SNAPSHOT_HEADER.pack(
+        frame, camera.x, camera.y, previous.x, previous.y,
+        player_count, platform_count)]
+    for _ in range(player_count):
+        offset = PLAYER_STATE.dequantize(state, offset, out)
+    for _ in range(platform_count):
+        offset = PLATFORM_STATE.dequantize(state, offset, out)
+
+    capacity, free = struct.unpack_from('<II', state, offset)
+    out.append(state[offset:offset + 8])
+    offset += 8
+    fixed = numpy.frombuffer(state, '<i4', capacity * 6, offset)
+    out.append((fixed / SCALE).astype('<f8').tobytes())
+    offset += fixed.nbytes
+    out.append(state[offset:])
+    return b''.join(out), masks
+
+
+class _Link(object):
+    """Sends datagrams, maybe late or not at all if we're pretending to be
+    a bad network. Keeps count of what went out."""
+    def __init__(self, transport, latency=0., jitter=0., loss=0., seed=None):
+        self.transport = transport
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.rng = random.Random(seed)
+        self.packets = 0
+        self.bytes = 0
+
+    def send(self, data, addr=None):
+        self.packets += 1
+        self.bytes += len(data)
+        if self.loss and self.rng.random() < self.loss:
+            return
+        delay = self.latency + self.rng.uniform(0, self.jitter)
+        if delay > 0:
+            asyncio.get_event_loop().call_later(delay, self._send, data, addr)
+        else:
+            self._send(data, addr)
+
+    def _send(self, data, addr):
+        if not self.transport.is_closing():
+            self.transport.sendto(data, addr)
+
+
+class _Remote(object):
+    """The server's view of one client."""
+    def __init__(self, addr, slot, now):
+        self.addr = addr
+        self.slot = slot
+        self.inputs = deque()  # (sequence number, mask) not yet applied
+        self.received = 0  # newest input sequence number seen
+        self.applied = 0  # newest input sequence number applied
+        self.ack = NO_BASE  # newest snapshot the client has
+        self.heard = now
+
+
+class Server(asyncio.DatagramProtocol):
+    """Runs `match` for real, taking inputs from whoever connects.
+
+    Each client gets the next player nobody's using; players without a
+    client just stand there. `snapshot_interval` is in ticks.
+    """
+    def __init__(self, match, level, tick_rate=60, snapshot_interval=3,
+                 latency=0., jitter=0., loss=0., seed=None):
+        self.match = match
+        self.level = level
+        self.dt = 1. / tick_rate
+        self.snapshot_interval = snapshot_interval
+        self.network = dict(latency=latency, jitter=jitter, loss=loss,
+                            seed=seed)
+        self.link = None
+        self.clients = {}
+        self.masks = [0] * len(match.players)
+        self.pressed_keys = {}
+        self.history = OrderedDict()  # frame -> encoded state
+
+    def connection_made(self, transport):
+        self.link = _Link(transport, **self.network)
+
+    def datagram_received(self, data, addr):
+        now = asyncio.get_event_loop().time()
+        if data[0] == HELLO:
+            self.welcome(addr, now)
+        elif data[0] == INPUT and addr in self.clients:
+            client = self.clients[addr]
+            client.heard = now
+            ack, first, count = INPUT_PACKET.unpack_from(data)[1:]
+            if ack != NO_BASE and (client.ack == NO_BASE or ack > client.ack):
+                client.ack = ack
+            masks = bytearray(data[INPUT_PACKET.size:])
+            for i, mask in enumerate(masks[:count]):
+                if first + i > client.received:
+                    client.inputs.append((first + i, mask))
+                    client.received = first + i
+
+    def welcome(self, addr, now):
+        client = self.clients.get(addr)
+        if client is None:
+            taken = set(c.slot for c in self.clients.values())
+            free = [i for i in range(len(self.masks)) if i not in taken]
+            if not free:
+                return  # full up
+            client = self.clients[addr] = _Remote(addr, free[0], now)
+        self.link.send(WELCOME_PACKET.pack(WELCOME, VERSION, client.slot,
+                                           self.match.frame,
+                                           len(self.match.players)) +
+                       self.level.encode('utf-8'), addr)
+
+    def tick(self):
+        now = asyncio.get_event_loop().time()
+        for addr, client in list(self.clients.items()):
+            if now - client.heard > TIMEOUT:
+                del self.clients[addr]
+                self.masks[client.slot] = 0
+                continue
+            # one input per tick; if none has arrived, keep doing the same
+            if client.inputs:
+                client.applied, self.masks[client.slot] = \
+                    client.inputs.popleft()
+        held = keys_held(self.match.players, self.masks)
+        self.match.step(hold_counts(self.pressed_keys, held), self.dt)
+        if self.match.frame % self.snapshot_interval == 0:
+            self.broadcast()
+
+    def broadcast(self):
+        frame = self.match.frame
+        state = self.history[frame] = encode_state(self.match, self.masks)
+        while len(self.history) > HISTORY:
+            self.history.popitem(last=False)
+        for client in self.clients.values():
+            base = self.history.get(client.ack)
+            if base is None or len(base) != len(state):
+                payload, base_frame = state, NO_BASE
+            else:
+                payload, base_frame = _xor(state, base), client.ack
+            self.link.send(SNAPSHOT_PACKET.pack(
+                SNAPSHOT, frame, base_frame, client.applied) +
+                zlib.compress(payload), client.addr)
+
+    async def run(self):
+        """Tick in real time, forever."""
+        loop = asyncio.get_event_loop()
+        next_tick = loop.time()
+        while True:
+            self.tick()
+            next_tick += self.dt
+            await asyncio.sleep(max(next_tick - loop.time(), 0))
+
+
+class Client(asyncio.DatagramProtocol):
+    """Plays one player of a match running on a server.
+
+    Call `tick` with the local input mask once per tick. Until the server
+    says hello back `match` is None; after that it's a local copy of the
+    match, predicted ahead of the server, to draw. If the server can't be
+    played with, `tick` raises why.
+    """
+    def __init__(self, make_match, tick_rate=60, latency=0., jitter=0.,
+                 loss=0., seed=None):
+        self.make_match = make_match
+        self.dt = 1. / tick_rate
+        self.network = dict(latency=latency, jitter=jitter, loss=loss,
+                            seed=seed)
+        self.link = None
+        self.match = None
+        self.error = None  # raised from tick, not in the event loop
+        self.slot = None
+        self.masks = []
+        self.pressed_keys = {}
+        self.sequence = 0
+        self.pending = deque()  # (sequence number, mask) not yet applied
+        self.states = OrderedDict()  # frame -> encoded state
+        self.ack = NO_BASE
+        self.waited = 0
+
+        # how it's going
+        self.received_packets = 0
+        self.received_bytes = 0
+        self.rollbacks = 0
+        self.resimulated = 0
+        self.correction = 0.  # how far off the last prediction was, in px
+
+    def connection_made(self, transport):
+        self.link = _Link(transport, **self.network)
+        self.link.send(HELLO_PACKET.pack(HELLO, VERSION))
+
+    def datagram_received(self, data, addr):
+        self.received_packets += 1
+        self.received_bytes += len(data)
+        if data[0] == WELCOME and self.match is None:
+            version, self.slot, _, players = \
+                WELCOME_PACKET.unpack_from(data)[1:]
+            if version != VERSION:
+                self.error = ValueError("server speaks protocol version "
+                                        "{}, not {}".format(version, VERSION))
+                return
+            level = bytes(data[WELCOME_PACKET.size:]).decode('utf-8')
+            self.match = self.make_match(level, players)
+            self.masks = [0] * len(self.match.players)
+        elif data[0] == SNAPSHOT and self.match is not None:
+            self.receive_snapshot(data)
+
+    def tick(self, mask):
+        if self.error is not None:
+            raise self.error
+        if self.match is None:
+            self.waited += 1
+            if self.waited % 30 == 0:  # the hello might have been lost
+                self.link.send(HELLO_PACKET.pack(HELLO, VERSION))
+            return
+        self.sequence += 1
+        self.pending.append((self.sequence, mask))
+        resend = list(self.pending)[-REDUNDANCY:]
+        self.link.send(INPUT_PACKET.pack(
+            INPUT, self.ack, resend[0][0], len(resend)) +
+            bytes(bytearray(m for _, m in resend)))
+        self.masks[self.slot] = mask
+        self.step()
+
+    def step(self):
+        held = keys_held(self.match.players, self.masks)
+        self.match.step(hold_counts(self.pressed_keys, held), self.dt)
+
+    def receive_snapshot(self, data):
+        frame, base, applied = SNAPSHOT_PACKET.unpack_from(data)[1:]
+        if self.ack != NO_BASE and frame <= self.ack:
+            return  # late or duplicated
+        state = zlib.decompress(bytes(data[SNAPSHOT_PACKET.size:]))
+        if base != NO_BASE:
+            reference = self.states.get(base)
+            if reference is None or len(reference) != len(state):
+                return  # can't undo the delta; a later one will do
+            state = _xor(state, reference)
+        self.states[frame] = state
+        while len(self.states) > HISTORY:
+            self.states.popitem(last=False)
+        self.ack = frame
+        while self.pending and self.pending[0][0] <= applied:
+            self.pending.popleft()
+        self.rollback(state)
+
+    def rollback(self, state):
+        """Jump back to the server's state, then replay the inputs it
+        hasn't applied yet on top."""
+        match = self.match
+        world = match.world
+        camera, previous_camera = world.camera, world.previous_camera
+        predicted = match.players[self.slot].body.position
+        predicted = (predicted.x, predicted.y)
+
+        snapshot, self.masks = decode_state(state, match)
+        match.restore(snapshot)
+        # a held key only counts as newly pressed on the tick it went down,
+        # and that tick is behind us
+        self.pressed_keys = dict.fromkeys(
+            keys_held(match.players, self.masks), 1)
+        for _, mask in self.pending:
+            self.masks[self.slot] = mask
+            self.step()
+
+        # the camera only follows along, so it doesn't get replayed
+        world.camera, world.previous_camera = camera, previous_camera
+        position = match.players[self.slot].body.position
+        self.correction = ((position.x - predicted[0]) ** 2 +
+                           (position.y - predicted[1]) ** 2) ** .5
+        self.rollbacks += 1
+        self.resimulated += len(self.pending)
+
+
+async def serve(match, level, port, host='0.0.0.0', **kwargs):
+    """Serve `match` on a UDP port until cancelled."""
+    loop = asyncio.get_event_loop()
+    server = Server(match, level, **kwargs)
+    transport, _ = await loop.create_datagram_endpoint(
+        lambda: server, local_addr=(host, port))
+    try:
+        await server.run()
+    finally:
+        transport.close()
+
+
+async def connect(host, port, make_match, **kwargs):
+    """Start talking to a server. Returns ``(transport, client)``; close
+    the transport when done. `make_match` is called with the server's
+    level and number of players to set up the local copy of the match."""
+    loop = asyncio.get_event_loop()
+    return await loop.create_datagram_endpoint(
+        lambda: Client(make_match, **kwargs), remote_addr=(host, port))
@@ -0,0 +1,59 @@
+"""Simulating the next ticks while the last ones are being drawn.
+
+Normally a frame runs its ticks and then draws the result. A Pipeline
+runs each frame's ticks on a worker thread instead, while the main thread
+draws a MatchView of where the previous frame's ticks left off. pymunk's
+step and SDL's blits both let go of the GIL, so the two really do run at
+once. What's on screen is one batch of ticks behind, in exchange for
+frames taking about as long as the slower of the two rather than both.
+
+The view is copied out on the worker as it finishes each batch, so the
+main thread never looks at the match while it's being stepped, and the
+worker never touches a view once it's handed over. The worker times its
+ticks with a profiler of its own, which `finish` adds into the match's.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+from game.profiler import FrameProfiler, NullProfiler
+
+
+class Pipeline(object):
+    """Runs a match's ticks a batch at a time on a worker thread.
+
+    Each frame, `finish` waits for the batch in flight and returns the
+    MatchView it ended on, then `start` sets off the next batch, and then
+    the view can be drawn. Between `start` and `finish`, leave the match
+    (and anything `tick` uses) alone, and draw with `profiler` rather
+    than the match's own, which belongs to the worker until `close`.
+    """
+    def __init__(self, match):
+        self.match = match
+        self.profiler = match.profiler
+        match.profiler = FrameProfiler() if self.profiler.enabled \
+            else NullProfiler()
+        self.view = match.view()
+        self.pending = None
+        self.worker = ThreadPoolExecutor(max_workers=1)
+
+    def start(self, tick, ticks):
+        """Call `tick` `ticks` times on the worker."""
+        self.pending = self.worker.submit(self.run, tick, ticks)
+
+    def run(self, tick, ticks):
+        for _ in range(ticks):
+            tick()
+        return self.match.view()
+
+    def finish(self):
+        """Wait for the ticks in flight, and return the view they left.
+        Anything that went wrong on the worker is raised here."""
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            self.view = pending.result()
+            self.profiler.merge(self.match.profiler)
+        return self.view
+
+    def close(self):
+        self.finish()
+        self.worker.shutdown()
+        self.match.profiler = self.profiler
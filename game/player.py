@@ -1,80 +1,47 @@
 """This module contains the entities controlled by the player."""
 import pygame
+import struct
 import weakref
+from collections import namedtuple
 from pymunk import Vec2d
 import pymunk
 from pymunk.pygame_util import to_pygame
-from game import BULLET_COLLISION_TYPE, SPACE, SCREEN_HALF, \
-    PLAYER_COLLISION_TYPE
-
-
-def _bullet_velocity_func(body, gravity, damping, dt):
-    return body.velocity
-
-
-class Bullet(object):
-    def __init__(self, owner, gravity=False):
-        self.radius = 3
-        self.speed = 500
-        self.ttl = 40
-        self.cooldown = 10
-
-        self.shot_sound = pygame.mixer.Sound("res/sfx/C_28P.ogg")
-        self.shot_sound.play()
-
-        facing_left = owner.current_facing == owner.left_key
-        vel = Vec2d(-self.speed, 0) if facing_left else Vec2d(self.speed, 0)
-        offset = Vec2d(0, -5) if facing_left else Vec2d(20, -5)
-        self.body = pymunk.Body(1, pymunk.inf)
-        self.body.position = owner.body.position + offset
-        self.body.velocity = owner.body.velocity + vel
-        self.body.bullet = weakref.proxy(self)
-        if not gravity:
-            self.body.velocity_func = _bullet_velocity_func
-        self.shape = pymunk.Circle(self.body, self.radius, (0, 0))
-        self.shape.collision_type = BULLET_COLLISION_TYPE
-        self.shape.friction = 0
-        SPACE.add(self.body, self.shape)
-        self.active = True
-
-    def update(self):
-        self.ttl -= 1
-        if self.ttl < 0:
-            self.destroy()
-        return self.active
-
-    def destroy(self):
-        try:
-            SPACE.remove(self.body, self.shape)
-            self.active = False
-        except KeyError:
-            pass
-
-    def draw(self, screen, camera):
-        if not self.active:
-            return
-        position = to_pygame(self.body.position - camera + SCREEN_HALF, screen)
-        pygame.draw.circle(screen, (0, 0, 0, 0), position, self.radius)
+from game import PLAYER_COLLISION_TYPE
+from game.assets import ASSETS
+
+# Everything it takes to draw a player, copied out of the simulation so it
+# can be drawn while the simulation carries on
+PlayerView = namedtuple('PlayerView', 'previous_position position flip '
+                        'sheet row frame health')
 
 
 class Animation(object):
-    def __init__(self, images, row, frame_count,
+    def __init__(self, sheet, row, frame_count,
                  start_frame=0, loop=False, frame_rate=.15):
-        self.img, self.flip_img = images
+        self.sheet = sheet
         self.row = row
         self.frame_count = frame_count
         self.start_frame = start_frame
         self.loop = loop
         self.frame_rate = frame_rate
+        self.reset()
+
+    def get_state(self):
+        return self.current_frame, self.frame, self.done
+
+    def set_state(self, current_frame, frame, done):
+        self.current_frame = current_frame
+        self.frame = frame
+        self.done = done
+
+    def reset(self):
         self.current_frame = 0
+        self.frame = 0
         self.done = False
 
-    def draw(self, screen, pos, flip):
-        # center the sprite
-        position = pos - Vec2d(48, 76)
-
-        # get the portion we should draw
-        frame = int(self.current_frame)
+    def tick(self):
+        """Advance the animation clock by one simulation step."""
+        self.frame = int(self.current_frame)
         self.current_frame += self.frame_rate
         if self.current_frame >= self.frame_count:
             if self.loop:
@@ -83,38 +50,48 @@ class Animation(object):
                 self.current_frame -= self.frame_rate  # stick on the last frame
                 self.done = True
 
-        img = self.flip_img if flip else self.img
-        # TODO: remove hardcoded sprite size
-        sprite_size = 128
-        x = (frame + self.start_frame) * sprite_size
-        if flip:
-            x = img.get_width() - x - sprite_size
-        y = self.row * sprite_size
-        screen.blit(img, position, (x, y, sprite_size, sprite_size))
+    def draw(self, screen, pos, flip, scale=1):
+        draw_frame(screen, self.sheet, self.row, self.frame + self.start_frame,
+                   pos, flip, scale)
+
+
+def draw_frame(screen, sheet, row, col, pos, flip, scale=1):
+    """Draw a frame of `sheet` centered on `pos`."""
+    position = pos - Vec2d(48, 76) * scale
+
+    img, offset = sheet.frame(row, col, flip, scale)
+    if img is not None:
+        screen.blit(img, (position.x + offset[0], position.y + offset[1]))
 
 
 class Player(object):
-    def __init__(self, name, img, up=None, left=None,
+    # Everything about a player that changes during a match; see get_state
+    STATE = struct.Struct('<6d3i2?3d?d3iB' + 'di?' * 5)
+
+    def __init__(self, space, bullets, name, img, up=None, left=None,
                  right=None, down=None, shoot=None):
+        self.space = space
+        self.bullets = bullets  # shared by everybody in the match
         self.name = name
 
         # sprites
-        img = pygame.image.load(img)
-        flip_img = pygame.transform.flip(img, True, False)
-        images = (img, flip_img)
+        sheet = ASSETS.sheet(img)  # shared with anyone else using it
 
         # animations
-        self.idle_loop = Animation(images, 1, 8, loop=True)
-        self.walk_loop = Animation(images, 3, 8, loop=True)
-        self.jump_loop = Animation(images, 5, 2, start_frame=4, loop=True)
+        self.idle_loop = Animation(sheet, 1, 8, loop=True)
+        self.walk_loop = Animation(sheet, 3, 8, loop=True)
+        self.jump_loop = Animation(sheet, 5, 2, start_frame=4, loop=True)
         self.spin_loop = Animation(
-            images, 7, 4, loop=True, frame_rate=0.4)
-        self.death_sequence = Animation(images, 8, 7)
+            sheet, 7, 4, loop=True, frame_rate=0.4)
+        self.death_sequence = Animation(sheet, 8, 7)
+        self.animation = self.idle_loop
+        self.animations = [self.idle_loop, self.walk_loop, self.jump_loop,
+                           self.spin_loop, self.death_sequence]
 
         # sounds
-        self.fall_sound = pygame.mixer.Sound("res/sfx/fall.wav")
+        self.fall_sound = ASSETS.sound("res/sfx/fall.wav")
         self.fall_sound.set_volume(0.5)
-        self.jump_sound = pygame.mixer.Sound("res/sfx/jump.wav")
+        self.jump_sound = ASSETS.sound("res/sfx/jump.wav")
         self.jump_sound.set_volume(0.5)
 
         # keybindings
@@ -128,6 +105,7 @@ class Player(object):
         self.body = pymunk.Body(5, pymunk.inf)  # mass, moment
         self.body.position = Vec2d(100, 100)
         self.body.player = weakref.proxy(self)
+        self.previous_position = Vec2d(self.body.position)
 
         # TODO: heads should be a separate collision type
         self.head = pymunk.Circle(self.body, 14, (12, 7))
@@ -139,7 +117,7 @@ class Player(object):
         # TODO: Make this zero whilst falling
         self.feet.friction = 2
 
-        SPACE.add(self.body, self.head, self.feet)
+        self.space.add(self.body, self.head, self.feet)
 
         # Character stats
         self.max_jumps = 2
@@ -150,44 +128,99 @@ class Player(object):
         self.health = self.max_health
         self.shot_cooldown = 0
 
-        # State tracking
+        # Match statistics
+        self.kills = 0
+        self.deaths = 0
+        self.damage_taken = 0
+
+        # State tracking; see game.contacts for how contacts get here
         self.landed = False
         self.landed_hard = False
+        self.ground_body = None
         self.ground_velocity = Vec2d.zero()
         self.ground_slope = 0
+        self.impact = 0.  # hardest landing this tick, as a change in speed
+        self.touching = 0  # shapes touching ours
         self.current_facing = self.right_key
-        self.bullets = []
 
     def update(self, pressed_keys):
-        for b in self.bullets[:]:  # iterate over a copy
-            if not b.update():
-                self.bullets.remove(b)
-
         # Tick the cooldown
         if self.shot_cooldown:
             self.shot_cooldown -= 1
-        self.landed = False
-        self.landed_hard = False
 
-        def calculate_landing(arbiter):
-            n = -arbiter.contacts[0].normal
-            shape = arbiter.shapes[1]
-            if n.y > 0 and shape.collision_type != BULLET_COLLISION_TYPE:
-                # wrap in Vec2d to copy the vector
-                v = Vec2d(shape.body.velocity)
-                self.ground_velocity = v
-                self.landed = True
-                # 100 is landed, 1000 is "being squished"
-                landing_speed = arbiter.total_impulse.y / self.body.mass
-                self.landed_hard = landing_speed > 100
-                if landing_speed > 1000:
-                    self.health -= 1
-                self.ground_slope = n.x / n.y
-        self.body.each_arbiter(calculate_landing)
+        # The contact handlers have filled in what we landed on, if anything
+        if self.landed:
+            # wrap in Vec2d to copy the vector
+            self.ground_velocity = Vec2d(self.ground_body.velocity)
+        # 100 is landed, 1000 is "being squished"
+        if self.impact > 1000:
+            self.take_damage(1)
+
+        if self.health > 0:  # No moving around for dead cats!
+            self.control(pressed_keys)
+        self.animate()
 
+    def take_damage(self, amount, attacker=None):
         if self.health <= 0:
-            return  # No moving around for you!
+            return  # already dead, don't count it twice
+        self.health -= amount
+        self.damage_taken += amount
+        if self.health <= 0:
+            self.deaths += 1
+            if attacker is not None and attacker != self:
+                attacker.kills += 1
+
+    def stats(self):
+        return {'name': self.name, 'kills': self.kills,
+                'deaths': self.deaths, 'damage_taken': self.damage_taken}
+
+    def get_state(self):
+        """All of this player's changing state as a flat tuple that packs
+        into Player.STATE."""
+        state = (self.body.position.x, self.body.position.y,
+                 self.body.velocity.x, self.body.velocity.y,
+                 self.previous_position.x, self.previous_position.y,
+                 self.health, self.remaining_jumps, self.shot_cooldown,
+                 self.landed, self.landed_hard,
+                 self.ground_velocity.x, self.ground_velocity.y,
+                 self.ground_slope,
+                 self.current_facing == self.left_key,
+                 self.feet.surface_velocity.x,
+                 self.kills, self.deaths, self.damage_taken,
+                 self.animations.index(self.animation))
+        for animation in self.animations:
+            state += animation.get_state()
+        return state
+
+    def set_state(self, state):
+        (x, y, vx, vy, px, py,
+         self.health, self.remaining_jumps, self.shot_cooldown,
+         self.landed, self.landed_hard, gx, gy, self.ground_slope,
+         facing_left, surface_vx,
+         self.kills, self.deaths, self.damage_taken,
+         animation) = state[:20]
+        self.body.position = (x, y)
+        self.body.velocity = (vx, vy)
+        self.previous_position = Vec2d(px, py)
+        self.ground_velocity = Vec2d(gx, gy)
+        self.current_facing = self.left_key if facing_left else self.right_key
+        self.feet.surface_velocity = (surface_vx, 0)
+        self.animation = self.animations[animation]
+        for i, a in enumerate(self.animations):
+            a.set_state(*state[20 + 3*i:23 + 3*i])
+
+    def prepare_step(self):
+        """Remember where everything was before the physics step, and
+        forget last step's landing.
+
+        Drawing interpolates from these positions to the stepped ones.
+        """
+        self.previous_position = Vec2d(self.body.position)
+        self.landed = False
+        self.landed_hard = False
+        self.impact = 0.
 
+    def control(self, pressed_keys):
         if self.landed and self.ground_slope < 2:
             self.remaining_jumps = self.max_jumps
 
@@ -204,9 +237,8 @@ class Player(object):
     def shoot(self):
         if self.shot_cooldown:
             return
-        bullet = Bullet(self)
-        self.bullets.append(bullet)
-        self.shot_cooldown = bullet.cooldown
+        self.bullets.fire(self)
+        self.shot_cooldown = self.bullets.cooldown
 
     def jump(self):
         if self.remaining_jumps:
@@ -214,50 +246,51 @@ class Player(object):
             self.body.velocity.y = self.ground_velocity.y + self.jump_speed
             self.remaining_jumps -= 1
 
-    def draw(self, screen, camera):
-        # match sprite to the physics object
-        position = self.body.position - camera + SCREEN_HALF
-        position = Vec2d(to_pygame(position, screen))
-
+    def animate(self):
         # play different animations depending on what's going on
         # TODO: These are all screwed up
-        flip = self.current_facing == self.left_key
-
         if self.health <= 0:
-            self.death_sequence.draw(screen, position, flip)
-            if self.death_sequence.done:
-                # respawn
-                self.health = self.max_health
-                self.body.position = Vec2d(100, 100)
+            self.animation = self.death_sequence
         elif self.landed and abs(self.feet.surface_velocity.x) > 1:
             # walking
-            self.walk_loop.draw(screen, position, flip)
+            self.animation = self.walk_loop
         elif self.landed:
             # idle
-            self.idle_loop.draw(screen, position, flip)
+            self.animation = self.idle_loop
         elif self.remaining_jumps > 0:
             # falling
-            self.jump_loop.draw(screen, position, flip)
+            self.animation = self.jump_loop
         elif self.remaining_jumps == 0:
             # spinning
-            self.spin_loop.draw(screen, position, flip)
+            self.animation = self.spin_loop
         else:
             # I dunno what else to do
-            self.idle_loop.draw(screen, position, flip)
+            self.animation = self.idle_loop
+        self.animation.tick()
 
-        # Draw health bar
-        health_percent = max(float(self.health) / self.max_health, 0)
-        if health_percent:
-            rect = (position.x, position.y - 35, 30 * health_percent, 5)
-            pygame.draw.rect(screen, (255, 0, 0, 0), rect)
+        if self.health <= 0 and self.death_sequence.done:
+            self.respawn()
 
         # Did we land?
         if self.landed_hard:
             self.fall_sound.play()
 
-        # Draw our bullets
-        for bullet in self.bullets:
-            bullet.draw(screen, camera)
+    def respawn(self):
+        self.health = self.max_health
+        self.body.position = Vec2d(100, 100)
+        self.previous_position = Vec2d(self.body.position)
+        self.death_sequence.reset()
+
+    def view(self):
+        animation = self.animation
+        return PlayerView(
+            Vec2d(self.previous_position), Vec2d(self.body.position),
+            self.current_facing == self.left_key, animation.sheet,
+            animation.row, animation.frame + animation.start_frame,
+            max(float(self.health) / self.max_health, 0))
+
+    def draw(self, screen, camera, alpha=1., scale=1):
+        return draw_player(screen, self.view(), camera, alpha, scale)
 
     def move(self, keys):
         target_vx = 0
@@ -280,3 +313,23 @@ class Player(object):
 
         # Terminal velocity
         self.body.velocity.y = max(self.body.velocity.y, -450)
+
+
+def draw_player(screen, view, camera, alpha=1., scale=1):
+    """Draw a PlayerView, returning how many things were drawn."""
+    # match sprite to the physics object, blending between the last two
+    # physics steps so rendering can run at a different rate
+    position = view.previous_position.interpolate_to(view.position, alpha)
+    half = Vec2d(screen.get_size()) / 2
+    position = Vec2d(to_pygame((position - camera) * scale + half, screen))
+
+    draw_frame(screen, view.sheet, view.row, view.frame, position, view.flip,
+               scale)
+
+    # Draw health bar
+    if view.health:
+        rect = (position.x, position.y - 35 * scale,
+                30 * view.health * scale, max(5 * scale, 1))
+        pygame.draw.rect(screen, (255, 0, 0, 0), rect)
+        return 2
+    return 1
@@ -0,0 +1,198 @@
+"""Where does the frame time go? Time each phase of the game loop, count
+what's in the world, and show it on screen or save it for later."""
+import csv
+import json
+from collections import OrderedDict, deque
+from timeit import default_timer as clock
+
+import pygame
+from pygame.color import THECOLORS
+
+PHASE_COLORS = [THECOLORS[c] for c in (
+    "dodgerblue", "orange", "limegreen", "red", "violet", "gold", "cyan",
+    "white")]
+
+
+class _Timer(object):
+    """Context manager that adds the time spent inside it to a phase."""
+    def __init__(self, frame, name):
+        self.frame = frame
+        self.name = name
+        self.start = 0
+
+    def __enter__(self):
+        self.start = clock()
+
+    def __exit__(self, *exc_info):
+        elapsed = (clock() - self.start) * 1000.
+        self.frame[self.name] = self.frame.get(self.name, 0) + elapsed
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class NullProfiler(object):
+    """Has the same interface as FrameProfiler, but does nothing at all."""
+    enabled = False
+    visible = False
+    _timer = _NullTimer()
+
+    def phase(self, name):
+        return self._timer
+
+    def count(self, name, value):
+        pass
+
+    def end_frame(self):
+        pass
+
+    def merge(self, other):
+        pass
+
+
+class FrameProfiler(object):
+    """Timings in milliseconds for each named phase of a frame, plus counts
+    of whatever's worth counting, over the last `history` frames.
+
+    Use ``with profiler.phase('physics'):`` around each bit of the loop,
+    `count` for the counts, and `end_frame` once a frame is over. With
+    `keep_rows` every frame is also kept for `export`.
+    """
+    enabled = True
+
+    def __init__(self, history=300, keep_rows=False):
+        self.history = history
+        self.phases = OrderedDict()
+        self.counters = OrderedDict()
+        self.frame = {}
+        self.counts = {}
+        self.timers = {}
+        self.rows = [] if keep_rows else None
+        self.frame_number = 0
+        self.visible = False
+
+    def phase(self, name):
+        timer = self.timers.get(name)
+        if timer is None:
+            timer = self.timers[name] = _Timer(self.frame, name)
+            self.phases[name] = deque(maxlen=self.history)
+        return timer
+
+    def count(self, name, value):
+        if name not in self.counters:
+            self.counters[name] = deque(maxlen=self.history)
+        self.counts[name] = value
+
+    def merge(self, other):
+        """Add in what `other` has timed and counted since it was last
+        merged, for part of a frame that ran on another thread with a
+        profiler of its own."""
+        for name, elapsed in other.frame.items():
+            self.phase(name)  # so it gets a column
+            self.frame[name] = self.frame.get(name, 0) + elapsed
+        for name, value in other.counts.items():
+            self.count(name, value)
+        other.frame.clear()
+        other.counts.clear()
+
+    def end_frame(self):
+        for name, samples in self.phases.items():
+            samples.append(self.frame.get(name, 0.))
+        for name, samples in self.counters.items():
+            samples.append(self.counts.get(name, 0))
+        if self.rows is not None:
+            row = OrderedDict(frame=self.frame_number)
+            for name in self.phases:
+                row[name + "_ms"] = round(self.frame.get(name, 0.), 4)
+            for name in self.counters:
+                row[name] = self.counts.get(name, 0)
+            self.rows.append(row)
+        self.frame.clear()
+        self.counts.clear()
+        self.frame_number += 1
+
+    def stats(self, name):
+        """Mean, median, 95th percentile and max of a phase or counter."""
+        samples = self.phases.get(name)
+        if samples is None:
+            samples = self.counters[name]
+        if not samples:
+            return 0, 0, 0, 0
+        ordered = sorted(samples)
+        last = len(ordered) - 1
+        return (sum(ordered) / float(len(ordered)), ordered[last // 2],
+                ordered[int(last * .95)], ordered[last])
+
+    def summary(self):
+        return OrderedDict(
+            (name, dict(zip(("mean", "median", "p95", "max"),
+                            self.stats(name))))
+            for name in list(self.phases) + list(self.counters))
+
+    def export(self, filename):
+        """Write every kept frame to a .csv, or everything including the
+        summary to a .json file."""
+        rows = self.rows or []
+        if filename.endswith('.csv'):
+            with open(filename, 'w') as f:
+                fields = ["frame"] + [n + "_ms" for n in self.phases] + \
+                    list(self.counters)
+                writer = csv.DictWriter(f, fields)
+                writer.writeheader()
+                writer.writerows(rows)
+        else:
+            with open(filename, 'w') as f:
+                json.dump({'summary': self.summary(), 'frames': rows}, f,
+                          indent=1)
+
+    def draw(self, screen, font):
+        """Overlay a table of phase timings and a graph of recent frames."""
+        if not self.visible:
+            return
+        x, y = 10, 24
+        width, height = 360, 100
+        lines = ["{:<14}{:>8}{:>8}{:>8}".format("ms", "mean", "p95", "max")]
+        for name in self.phases:
+            mean, _, p95, worst = self.stats(name)
+            lines.append("{:<14}{:>8.2f}{:>8.2f}{:>8.2f}".format(
+                name, mean, p95, worst))
+        for name in self.counters:
+            mean, _, p95, worst = self.stats(name)
+            lines.append("{:<14}{:>8.0f}{:>8.0f}{:>8.0f}".format(
+                name, mean, p95, worst))
+
+        panel = pygame.Surface((width, height + 18 * len(lines) + 10))
+        panel.set_alpha(200)
+        panel.fill((0, 0, 0))
+        screen.blit(panel, (x - 5, y - 5))
+
+        # one stacked column per frame, 1px per 1/4 ms, 60fps line marked
+        scale = 4.
+        for column in range(min(self.history, width)):
+            bottom = y + height
+            for i, samples in enumerate(self.phases.values()):
+                index = len(samples) - width + column
+                if index < 0:
+                    continue
+                bar = int(samples[index] * scale)
+                if bar:
+                    color = PHASE_COLORS[i % len(PHASE_COLORS)]
+                    pygame.draw.line(screen, color, (x + column, bottom),
+                                     (x + column, bottom - bar))
+                    bottom -= bar
+        target = y + height - int(1000. / 60 * scale)
+        pygame.draw.line(screen, THECOLORS["white"], (x, target),
+                         (x + width, target))
+
+        y += height + 5
+        for i, line in enumerate(lines):
+            color = THECOLORS["white"]
+            if 0 < i <= len(self.phases):
+                color = PHASE_COLORS[(i - 1) % len(PHASE_COLORS)]
+            screen.blit(font.render(line, 1, color), (x, y))
+            y += 18
@@ -0,0 +1,269 @@
+"""Recording a match's input and playing it back.
+
+A replay mostly stores which keys went down or up on which tick. That
+isn't enough on its own, because the simulation isn't deterministic:
+when two cats touch, Chipmunk decides which shape is which by comparing
+their addresses in memory. So the same keys on the same ticks can play
+out a little differently from one process to the next. To make up for
+it, every `hash_interval` ticks the replay also keeps a keyframe, a
+Match.snapshot of the whole match, and a hash of the match state.
+
+Strict playback stops at the first keyframe whose hash doesn't match,
+which is what you want when chasing a bug: it might be Chipmunk, or it
+might be state that Match.snapshot leaves out. Otherwise playback notes
+the frame and jumps back onto the keyframe, so it never wanders further
+than one interval's worth, which is good enough for watching.
+
+A replay file is a small header followed by varint-encoded runs of
+``(ticks since the last change, number of changes, key << 1 | down...)``,
+then the state hashes, then the zlib-compressed keyframes, each one
+preceded by its length.
+
+    python -m game.replay --check [--resync]
+
+records a bot match in one process and plays it back strictly in
+another, or with `--resync`, all the way through listing every frame it
+desynced on. Either way it only passes if every keyframe matched.
+"""
+import os
+import struct
+import subprocess
+import sys
+import tempfile
+import zlib
+
+MAGIC = b'CATR'
+VERSION = 3
+# tick rate, seed, frames, hash interval, players
+HEADER = struct.Struct('<4sHHqIIH')
+HASH = struct.Struct('<I')
+
+
+class DesyncError(Exception):
+    """The match didn't hash the same as the replay at a keyframe, or
+    didn't even once put back on it, which means the replay is from
+    another version of the game or the level."""
+    def __init__(self, frame, expected, actual):
+        super(DesyncError, self).__init__(
+            "replay desynced by frame {} (state hash {:08x}, "
+            "expected {:08x})".format(frame, actual, expected))
+        self.frame = frame
+
+
+def _write_varint(out, value):
+    while value > 0x7f:
+        out.append(0x80 | (value & 0x7f))
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(data, offset):
+    value = shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+def hold_counts(old_pressed_keys, held):
+    """Update a key -> ticks held mapping for the keys held this tick."""
+    for k in held:
+        old_pressed_keys[k] = old_pressed_keys.get(k, 0) + 1
+    for k in list(old_pressed_keys.keys()):
+        if k not in held:
+            del old_pressed_keys[k]
+    return old_pressed_keys
+
+
+class Replay(object):
+    def __init__(self, level, seed=0, tick_rate=60, hash_interval=60,
+                 players=4):
+        self.level = level
+        self.players = players
+        self.seed = seed
+        self.tick_rate = tick_rate
+        self.hash_interval = hash_interval
+        self.frames = 0
+        self.changes = []  # (frame, [(key, down), ...])
+        self.hashes = []  # one every hash_interval frames
+        self.keyframes = []  # compressed snapshots, as often as the hashes
+
+    def save(self, filename):
+        level = self.level.encode('utf-8')
+        out = bytearray(HEADER.pack(MAGIC, VERSION, self.tick_rate,
+                                    self.seed, self.frames,
+                                    self.hash_interval, self.players))
+        _write_varint(out, len(level))
+        out += level
+        _write_varint(out, len(self.changes))
+        last = 0
+        for frame, changes in self.changes:
+            _write_varint(out, frame - last)
+            _write_varint(out, len(changes))
+            for key, down in changes:
+                _write_varint(out, key << 1 | int(down))
+            last = frame
+        _write_varint(out, len(self.hashes))
+        for h in self.hashes:
+            out += HASH.pack(h)
+        _write_varint(out, len(self.keyframes))
+        for keyframe in self.keyframes:
+            _write_varint(out, len(keyframe))
+            out += keyframe
+        with open(filename, 'wb') as f:
+            f.write(out)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, 'rb') as f:
+            data = bytearray(f.read())
+        (magic, version, tick_rate, seed, frames, hash_interval,
+         players) = HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("{} is not a version {} replay".format(
+                filename, VERSION))
+        offset = HEADER.size
+        length, offset = _read_varint(data, offset)
+        level = bytes(data[offset:offset + length]).decode('utf-8')
+        offset += length
+
+        replay = cls(level, seed, tick_rate, hash_interval, players)
+        replay.frames = frames
+        count, offset = _read_varint(data, offset)
+        frame = 0
+        for _ in range(count):
+            delta, offset = _read_varint(data, offset)
+            n, offset = _read_varint(data, offset)
+            frame += delta
+            changes = []
+            for _ in range(n):
+                code, offset = _read_varint(data, offset)
+                changes.append((code >> 1, bool(code & 1)))
+            replay.changes.append((frame, changes))
+        count, offset = _read_varint(data, offset)
+        for _ in range(count):
+            replay.hashes.append(HASH.unpack_from(data, offset)[0])
+            offset += HASH.size
+        count, offset = _read_varint(data, offset)
+        for _ in range(count):
+            length, offset = _read_varint(data, offset)
+            replay.keyframes.append(bytes(data[offset:offset + length]))
+            offset += length
+        return replay
+
+
+class Recorder(object):
+    """Records the keys pressed each tick into a Replay.
+
+    Call `record` with each tick's pressed keys (or, given a `source`, use
+    it as an input source itself), and `after_step` once the match has
+    stepped so the state hashes and keyframes get recorded too.
+    """
+    def __init__(self, level, seed=0, tick_rate=60, hash_interval=60,
+                 source=None, players=4):
+        self.replay = Replay(level, seed, tick_rate, hash_interval, players)
+        self.source = source
+        self.held = set()
+
+    def __call__(self, frame, players):
+        return self.record(self.source(frame, players))
+
+    def record(self, pressed_keys):
+        held = set(pressed_keys)
+        changed = held ^ self.held
+        if changed:
+            self.replay.changes.append(
+                (self.replay.frames,
+                 sorted((k, k in held) for k in changed)))
+        self.held = held
+        self.replay.frames += 1
+        return pressed_keys
+
+    def after_step(self, match):
+        if match.frame % self.replay.hash_interval == 0:
+            self.replay.hashes.append(match.state_hash())
+            self.replay.keyframes.append(zlib.compress(match.snapshot()))
+
+    def save(self, filename):
+        self.replay.save(filename)
+
+
+class Playback(object):
+    """An input source that plays a Replay back.
+
+    Its `after_step` checks the match against each keyframe as it reaches
+    it, keeping in `desyncs` the frames it had wandered off on. If
+    `strict`, it raises DesyncError the first time; otherwise it puts the
+    match back on the keyframe, and only raises if that doesn't work.
+    """
+    def __init__(self, replay, strict=False):
+        self.replay = replay
+        self.changes = iter(replay.changes)
+        self.next_change = next(self.changes, None)
+        self.held = set()
+        self.pressed_keys = {}
+        self.frame = 0
+        self.strict = strict
+        self.desyncs = []
+
+    @property
+    def done(self):
+        return self.frame >= self.replay.frames
+
+    def __call__(self, frame=None, players=None):
+        while self.next_change and self.next_change[0] <= self.frame:
+            for key, down in self.next_change[1]:
+                if down:
+                    self.held.add(key)
+                else:
+                    self.held.discard(key)
+            self.next_change = next(self.changes, None)
+        self.frame += 1
+        return hold_counts(self.pressed_keys, self.held)
+
+    def after_step(self, match):
+        interval = self.replay.hash_interval
+        if match.frame % interval:
+            return
+        index = match.frame // interval - 1
+        if index >= len(self.replay.hashes):
+            return
+        expected = self.replay.hashes[index]
+        actual = match.state_hash()
+        if actual == expected:
+            return
+        self.desyncs.append(match.frame)
+        if self.strict:
+            raise DesyncError(match.frame, expected, actual)
+        match.restore(zlib.decompress(self.replay.keyframes[index]))
+        actual = match.state_hash()
+        if actual != expected:
+            raise DesyncError(match.frame, expected, actual)
+
+
+def check(level='levels/level.tmx', frames=3600, resync=False):
+    """Record a bot match with main.py in one process and play it back in
+    another, strictly unless `resync`. Returns the playback's exit status,
+    0 only if every keyframe matched."""
+    handle, filename = tempfile.mkstemp(suffix='.rep')
+    os.close(handle)
+    try:
+        subprocess.check_call([sys.executable, 'main.py', '--headless',
+                               '--level', level, '--frames', str(frames),
+                               '--record', filename])
+        return subprocess.call([sys.executable, 'main.py', '--headless',
+                                '--replay', filename] +
+                               (['--resync'] if resync else []))
+    finally:
+        os.remove(filename)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] not in (['--check'], ['--check', '--resync']):
+        sys.exit("usage: python -m game.replay --check [--resync]")
+    status = check(resync='--resync' in sys.argv)
+    print("replay check {}".format("failed" if status else "passed"))
+    sys.exit(status)
@@ -0,0 +1,84 @@
+"""Trading resolution for frame rate.
+
+When frames take too long, DynamicResolution has the match drawn into a
+smaller surface, with everything in it scaled down to match, and then
+stretched up to fill the window. The picture gets softer but the frame
+rate holds. Once there's time to spare it steps back up again.
+
+Scales go up and down in eighths, so tiles and chunks always come out a
+whole number of pixels across and there are only a few sizes of each to
+keep around.
+"""
+import pygame
+
+STEP = 1 / 8.
+
+
+def _snap(scale):
+    return max(round(scale / STEP) * STEP, STEP)
+
+
+class DynamicResolution(object):
+    """Picks the scale to draw at from how long frames have been taking.
+
+    Each frame, draw into `surface(screen)` with `scale`, `present` it,
+    then `update` with how long the frame took. Frames are averaged, and
+    the scale only moves once the average has been over the target by
+    `hysteresis` (as a fraction of it), or would still be under it by
+    that much at the next scale up. After each change it waits `settle`
+    frames for the average to catch up before changing again.
+    """
+    def __init__(self, target_ms=1000 / 60., min_scale=.5, max_scale=1.,
+                 hysteresis=.1, settle=30, smoothing=.1):
+        self.target_ms = target_ms
+        self.min_scale = _snap(min_scale)
+        self.max_scale = max(_snap(max_scale), self.min_scale)
+        self.hysteresis = hysteresis
+        self.settle = settle
+        self.smoothing = smoothing
+        self.scale = self.max_scale
+        self.average_ms = target_ms
+        self.wait = settle
+        self.surfaces = {}  # scale -> surface to draw into at that scale
+
+    def surface(self, screen):
+        """What to draw into this frame; the screen itself at full size."""
+        if self.scale == 1:
+            return screen
+        surface = self.surfaces.get(self.scale)
+        if surface is None:
+            width, height = screen.get_size()
+            surface = pygame.Surface((int(width * self.scale),
+                                      int(height * self.scale)))
+            if pygame.display.get_surface() is not None:
+                surface = surface.convert()
+            self.surfaces[self.scale] = surface
+        return surface
+
+    def present(self, surface, screen):
+        """Stretch what was drawn into `surface` over all of `screen`."""
+        if surface is not screen:
+            pygame.transform.scale(surface, screen.get_size(), screen)
+
+    def update(self, frame_ms):
+        """Take the time the last frame took into account, and return the
+        scale to draw the next one at."""
+        self.average_ms += (frame_ms - self.average_ms) * self.smoothing
+        if self.wait:
+            self.wait -= 1
+            return self.scale
+
+        scale = self.scale
+        if self.average_ms > self.target_ms * (1 + self.hysteresis):
+            scale = max(scale - STEP, self.min_scale)
+        elif scale < self.max_scale:
+            # drawing costs about as much as the pixels drawn, so guess at
+            # what the next size up would cost before going there
+            bigger = min(scale + STEP, self.max_scale)
+            expected = self.average_ms * (bigger / scale) ** 2
+            if expected < self.target_ms * (1 - self.hysteresis):
+                scale = bigger
+        if scale != self.scale:
+            self.scale = scale
+            self.wait = self.settle
+        return scale
@@ -0,0 +1,150 @@
+"""Keeping only the level geometry near the action in the physics space.
+
+The level is cut into square regions. Every static shape belongs to
+the regions its bounding box touches, and every moving platform to the
+regions its whole route touches. Regions around the players and the
+camera are active; a shape is in the space while any of its regions
+is, and a moving platform is awake (stepped, and its shapes in the
+space) while any of its regions is.
+
+A platform that's asleep isn't stepped at all. When it wakes up it
+jumps straight to wherever its route would have taken it in the
+meantime.
+"""
+from game import SCREEN_HALF
+
+REGION_TILES = 16  # regions are this many tiles on a side
+PLAYER_MARGIN = 512  # px around each player to keep loaded
+CAMERA_MARGIN = 256  # px past the edges of the screen to keep loaded
+
+
+def _bounds(points, radius=0):
+    """The box around `points`, as ``(left, bottom, right, top)``."""
+    xs = [p[0] for p in points]
+    ys = [p[1] for p in points]
+    return (min(xs) - radius, min(ys) - radius,
+            max(xs) + radius, max(ys) + radius)
+
+
+class RegionStreamer(object):
+    def __init__(self, space, platforms, region_size):
+        self.space = space
+        self.region_size = region_size
+        self.shapes = {}  # region -> static shapes touching it
+        self.platforms = {}  # region -> moving platforms passing through
+        self.refs = {}  # shape or platform -> its regions that are active
+
+        for platform in platforms:
+            for members, item, bounds in self.entries(platform):
+                self.add(members, item, bounds)
+
+        # everything starts out in the space
+        self.active = set(self.shapes) | set(self.platforms)
+
+    def entries(self, platform):
+        """``(members, item, bounds)`` for what's streamed of `platform`:
+        its route for a moving platform, or else each shape."""
+        if platform.waypoints:
+            if not platform.shapes:
+                return []
+            # shape bounds, offset to every stop along the way
+            x0, y0, x1, y1 = _bounds(
+                [corner for bounds in platform.bounds
+                 for corner in (bounds[:2], bounds[2:])])
+            route = _bounds(platform.waypoints)
+            bounds = (x0 + route[0], y0 + route[1],
+                      x1 + route[2], y1 + route[3])
+            return [(self.platforms, platform, bounds)]
+        return [(self.shapes, shape, bounds)
+                for shape, bounds in zip(platform.shapes, platform.bounds)]
+
+    def add(self, members, item, bounds):
+        regions = self.regions(bounds)
+        for region in regions:
+            members.setdefault(region, []).append(item)
+        self.refs[item] = len(regions)
+        return regions
+
+    def track(self, platform, tick):
+        """Start streaming a platform made after the rest. Its shapes have
+        just gone in the space, so take out any nowhere near the action."""
+        for members, item, bounds in self.entries(platform):
+            regions = self.add(members, item, bounds)
+            self.refs[item] = len(self.active.intersection(regions))
+        if platform.waypoints:
+            if platform.shapes and not self.refs[platform]:
+                platform.sleep(tick)
+            return
+        for shape in platform.shapes:
+            if not self.refs[shape]:
+                self.space.remove(shape)
+
+    def untrack(self, platform):
+        """Stop streaming `platform`, taking whatever's left of it out of
+        the space."""
+        for members, item, bounds in self.entries(platform):
+            for region in self.regions(bounds):
+                members[region].remove(item)
+                if not members[region]:
+                    del members[region]
+            loaded = self.refs.pop(item)
+            if item is not platform and loaded:
+                self.space.remove(item)
+        if platform.waypoints and platform.shapes and \
+                platform.asleep_since is None:
+            self.space.remove(*platform.shapes)
+
+    def regions(self, bounds):
+        size = self.region_size
+        x0, y0, x1, y1 = bounds
+        return [(rx, ry)
+                for rx in range(int(x0 // size), int(x1 // size) + 1)
+                for ry in range(int(y0 // size), int(y1 // size) + 1)]
+
+    def wanted(self, players, camera):
+        """Every region near a player or the camera."""
+        boxes = [(camera.x - SCREEN_HALF.x - CAMERA_MARGIN,
+                  camera.y - SCREEN_HALF.y - CAMERA_MARGIN,
+                  camera.x + SCREEN_HALF.x + CAMERA_MARGIN,
+                  camera.y + SCREEN_HALF.y + CAMERA_MARGIN)]
+        for player in players:
+            x, y = player.body.position
+            boxes.append((x - PLAYER_MARGIN, y - PLAYER_MARGIN,
+                          x + PLAYER_MARGIN, y + PLAYER_MARGIN))
+        wanted = set()
+        for box in boxes:
+            wanted.update(r for r in self.regions(box)
+                          if r in self.shapes or r in self.platforms)
+        return wanted
+
+    def refresh(self, players, camera, tick, dt):
+        """Load what's come into range and unload what's gone out of it.
+
+        Only regions that changed since last time cost anything.
+        """
+        wanted = self.wanted(players, camera)
+        # load first, so anything in both a region going and a region
+        # coming stays put
+        for region in wanted - self.active:
+            for shape in self.shapes.get(region, ()):
+                self.refs[shape] += 1
+                if self.refs[shape] == 1:
+                    self.space.add(shape)
+            for platform in self.platforms.get(region, ()):
+                self.refs[platform] += 1
+                if platform.asleep_since is not None:
+                    platform.wake(tick, dt)
+        for region in self.active - wanted:
+            for shape in self.shapes.get(region, ()):
+                self.refs[shape] -= 1
+                if not self.refs[shape]:
+                    self.space.remove(shape)
+            for platform in self.platforms.get(region, ()):
+                self.refs[platform] -= 1
+                if not self.refs[platform] and platform.asleep_since is None:
+                    platform.sleep(tick)
+        self.active = wanted
+
+    def awake(self, platform):
+        """Whether `platform` should be awake with the current regions."""
+        return self.refs[platform] > 0
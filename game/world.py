@@ -1,96 +1,219 @@
 """The primary game object lives in this module."""
+import numpy
 import pygame
-from xml.etree import ElementTree
+import struct
+from collections import OrderedDict
 from pygame.color import THECOLORS
 from pymunk import Vec2d
 import pymunk
-from pymunk.pygame_util import to_pygame
-from game import SCREEN_HALF, JUMP_THROUGH_COLLISION_TYPE, SPACE
+from game import SCREEN_SIZE, JUMP_THROUGH_COLLISION_TYPE
+from game.assets import ASSETS, convert
+from game.geometry import Box, optimize, tune_spatial_hash
+from game.level import load_level
+from game.streaming import REGION_TILES, RegionStreamer
+
+# Layers are rendered in square chunks of this many tiles on a side
+CHUNK_TILES = 8
 
 
 class Tileset(object):
     def __init__(self, filename):
-        self.img = pygame.image.load(filename)
+        self.img = ASSETS.image(filename)
         self.tile_width = 32
         self.tile_height = 32
 
-    def draw(self, screen, tile_id, position):
-        if not tile_id:
-            return  # There was nothing to be drawn
-        tile_id -= 1  # we're 1-indexed in Tiled
-        tiles_wide = self.img.get_width() // self.tile_width
-        source_x = (tile_id % tiles_wide) * self.tile_width
-        source_y = (tile_id // tiles_wide) * self.tile_height
-        screen.blit(self.img, to_pygame(position, screen),
-                    (source_x, source_y, self.tile_width, self.tile_height))
+        # Cut the image up into an array of tiles indexed by tile id, so a
+        # whole block of tile ids can be turned into pixels in one go.
+        # Tiled counts from 1, so tile 0 is the empty (transparent) one.
+        w, h = self.tile_width, self.tile_height
+        tiles_wide = self.img.get_width() // w
+        tiles_high = self.img.get_height() // h
+        pixels = numpy.dstack((pygame.surfarray.array3d(self.img),
+                               pygame.surfarray.array_alpha(self.img)))
+        pixels = pixels.transpose(1, 0, 2)[:tiles_high*h, :tiles_wide*w]
+        tiles = pixels.reshape(tiles_high, h, tiles_wide, w, 4)
+        tiles = tiles.transpose(0, 2, 1, 3, 4).reshape(-1, h, w, 4)
+        self.tiles = numpy.concatenate(
+            (numpy.zeros((1, h, w, 4), numpy.uint8), tiles))
+
+    def render(self, data):
+        """Turn a 2d array of tile ids into a [y, x, rgba] pixel array."""
+        rows, cols = data.shape
+        # ids past the end of the image have nothing to draw, like 0
+        data = numpy.where(data < len(self.tiles), data, 0)
+        pixels = self.tiles[data]  # [row, col, y, x, rgba]
+        return pixels.transpose(0, 2, 1, 3, 4).reshape(
+            rows*self.tile_height, cols*self.tile_width, 4)
+
+
+class ChunkCache(object):
+    """Holds on to the most recently used chunks, forgetting the stalest
+    once there are more than `max_chunks` of them."""
+    def __init__(self, render, max_chunks):
+        self.render = render
+        self.max_chunks = max_chunks
+        self.chunks = OrderedDict()
+
+    def get(self, key):
+        try:
+            chunk = self.chunks.pop(key)
+        except KeyError:
+            chunk = self.render(*key)
+            if len(self.chunks) >= self.max_chunks:
+                self.chunks.popitem(last=False)
+        self.chunks[key] = chunk  # now the most recently used
+        return chunk
+
+    def invalidate(self, key=None):
+        if key is None:
+            self.chunks.clear()
+        else:
+            self.chunks.pop(key, None)
+
+    def invalidate_chunks(self, chunks):
+        """Forget every scale of each ``(layer, cx, cy)`` in `chunks`."""
+        for key in [k for k in self.chunks if k[:3] in chunks]:
+            del self.chunks[key]
 
 
 class TileWorld(object):
-    def __init__(self, filename):
+    def __init__(self, space, filename, render=True, max_chunks=None,
+                 boxes=False):
+        self.space = space
+        self.boxes = boxes
+        self.ticks = 0
+        self.dt = 0.
+
         # Somebody set up us the camera
         self.camera = Vec2d(0, 0)
+        self.previous_camera = self.camera
 
         # Load the Tileset
         # TODO: tileset is hardcoded
-        self.tileset = Tileset('res/images/mininicular.png')
+        self.tileset = None
+        if render:
+            self.tileset = Tileset('res/images/mininicular.png')
 
-        # Parse the TMX
-        self.tree = ElementTree.parse(filename)
-        root = self.tree.getroot()
-        dim = Vec2d(int(root.get('width')), int(root.get('height')))
-        t_size = Vec2d(int(root.get('tilewidth')), int(root.get('tileheight')))
+        # Load the level, compiled or straight from the TMX
+        level = load_level(filename)
+        dim = Vec2d(level.width, level.height)
+        t_size = Vec2d(level.tile_width, level.tile_height)
         self.map_size = Vec2d(t_size.x*dim.x, t_size.y*dim.y)
-        layers = []
-        for layer in root.findall('layer'):
-            # This is the csv of the map data
-            csv = layer.findall('data')[0].text
-            # pygame is opposite of Tiled, so needs reversed
-            new_layer = list(reversed([row for row in csv.split('\n')]))
-            layers.append(new_layer)
-
-        # These are the collision objects
-        self.platforms = []
-        for object_group in root.findall('objectgroup'):
-            for obj in object_group.iter('object'):
-                jump_through = False
-                speed = 1
-                waypoints = []
-                group_offset = Vec2d(int(obj.get('x')), int(obj.get('y')))
-                for p in obj.iter('property'):
-                    if p.get('name') == "jump_through":
-                        jump_through = True
-                    if p.get('name') == "speed":
-                        speed = int(p.get('value'))
-                    if p.get('name') == "waypoints":
-                        waypoints = self.pointify(p.get('value'))
-                line = obj.find('polyline')
-                points = self.pointify(line.get('points'),
-                                       group_offset=group_offset)
-                p = Platform(points, jump_through=jump_through, speed=speed,
-                             waypoints=waypoints)
-                self.platforms.append(p)
-
-        # Pre-generate the surfaces
-        self.surfaces = []
-        for layer in layers:
-            surf = pygame.Surface(self.map_size, pygame.SRCALPHA, 32)
-            self.generate_surface(surf, layer)
-            self.surfaces.append(surf)
-
-    def pointify(self, csv_string, group_offset=Vec2d.zero()):
-        if group_offset.y:
-            offset = self.map_size.y - group_offset.y
+        self.tile_size = t_size
+        # arrays of tile ids, indexed by [row, column]
+        self.layers = level.layers
+
+        # These are the collision objects, boiled down to as few shapes as
+        # will do, with the broadphase tuned to suit them
+        platforms, found = optimize(level.platforms, t_size, boxes=boxes)
+        self.platforms = [self.make_platform(item)
+                          for item in platforms + found]
+        self.moving = [p for p in self.platforms if p.waypoints]
+        tune_spatial_hash(space, self.map_size, [
+            max(right - left, top - bottom)
+            for p in self.platforms for left, bottom, right, top in p.bounds])
+
+        # Only the geometry near the players stays in the physics space
+        self.streamer = RegionStreamer(
+            space, self.platforms, REGION_TILES * t_size.x)
+
+        # Layers get rendered a chunk at a time as they come into view
+        self.chunk_size = Vec2d(t_size.x*CHUNK_TILES, t_size.y*CHUNK_TILES)
+        self.chunk_count = (int(-(-dim.x // CHUNK_TILES)),
+                            int(-(-dim.y // CHUNK_TILES)))
+        if max_chunks is None:
+            # enough for every layer to fill the screen twice over
+            across = SCREEN_SIZE.x // self.chunk_size.x + 2
+            down = SCREEN_SIZE.y // self.chunk_size.y + 2
+            max_chunks = int(2 * across * down * len(self.layers))
+        self.chunks = ChunkCache(self.render_chunk, max_chunks)
+
+    def make_platform(self, item):
+        """A Platform for a PlatformInfo or a Box out of `optimize`,
+        remembering which so `reload` can tell if it's still wanted."""
+        if isinstance(item, Box):
+            platform = Platform(self.space, (), box=item)
+        else:
+            platform = Platform(self.space, item.points,
+                                jump_through=item.jump_through,
+                                speed=item.speed, waypoints=item.waypoints)
+        platform.source = _source_key(item)
+        return platform
+
+    def reload(self, level):
+        """Bring the world up to date with `level`, a fresh load of the
+        same map, touching only what changed.
+
+        Chunks with any tile changed are dropped from the cache to be
+        rendered again, and only the platforms that are new or gone are
+        added to or taken out of the space. Players, bullets, the camera
+        and platforms that didn't change carry on as they were. Returns
+        how many chunks, then platforms, were added or dropped.
+        """
+        stale = set()
+        t_size = Vec2d(level.tile_width, level.tile_height)
+        resized = t_size != self.tile_size or len(level.layers) != len(
+            self.layers) or any(new.shape != old.shape for new, old
+                                in zip(level.layers, self.layers))
+        if not resized:
+            for i, (new, old) in enumerate(zip(level.layers, self.layers)):
+                rows, cols = numpy.nonzero(new != old)
+                stale.update(
+                    (i, cx, cy) for cy, cx in zip(
+                        (rows // CHUNK_TILES).tolist(),
+                        (cols // CHUNK_TILES).tolist()))
+            self.chunks.invalidate_chunks(stale)
         else:
-            offset = 0
-        point_strings = [p.split(',') for p in csv_string.split()]
-        return [(group_offset.x + int(p[0]),
-                 offset-int(p[1])) for p in point_strings]
+            # a different size altogether, so every chunk is new
+            self.tile_size = t_size
+            self.map_size = Vec2d(t_size.x*level.width,
+                                  t_size.y*level.height)
+            self.chunk_size = Vec2d(t_size.x*CHUNK_TILES,
+                                    t_size.y*CHUNK_TILES)
+            self.chunk_count = (int(-(-level.width // CHUNK_TILES)),
+                                int(-(-level.height // CHUNK_TILES)))
+            stale.update((i, cx, cy) for i in range(len(level.layers))
+                         for cx in range(self.chunk_count[0])
+                         for cy in range(self.chunk_count[1]))
+            self.chunks.invalidate()
+        self.layers = level.layers
+
+        # match what's wanted against what we've got, source by source
+        platforms, found = optimize(level.platforms, self.tile_size,
+                                    boxes=self.boxes)
+        unused = {}
+        for p in self.platforms:
+            unused.setdefault(p.source, []).append(p)
+        kept, added = [], []
+        for item in platforms + found:
+            same = unused.get(_source_key(item))
+            if same:
+                kept.append(same.pop())
+            else:
+                added.append(self.make_platform(item))
+        removed = [p for ps in unused.values() for p in ps]
+        for p in removed:
+            self.streamer.untrack(p)
+        for p in added:
+            self.streamer.track(p, self.ticks)
+
+        self.platforms = kept + added
+        self.moving = [p for p in self.platforms if p.waypoints]
+        if resized:
+            tune_spatial_hash(self.space, self.map_size, [
+                max(right - left, top - bottom) for p in self.platforms
+                for left, bottom, right, top in p.bounds])
+        return len(stale), len(added) + len(removed)
 
     def update(self, dt, players):
         # TODO: damage players outside of the map
+        self.previous_camera = self.camera
+        self.ticks += 1
+        self.dt = dt
 
-        for p in self.platforms:
-            p.update(dt, players)
+        for p in self.moving:
+            if p.asleep_since is None:
+                p.update(dt, players)
 
         # Make the camera follow the center of the players
         living_players = [p for p in players if p.health > 0]
@@ -102,55 +225,157 @@ class TileWorld(object):
         camera_speed = max(distance**.5 / 3, .01)
         self.camera = self.camera.interpolate_to(position, camera_speed / distance)
 
+    def stream(self, players):
+        """Put what's near the players and camera in the physics space, and
+        take out what isn't. Call it before every physics step."""
+        self.streamer.refresh(players, self.camera, self.ticks, self.dt)
+
+    def restored(self, ticks, players):
+        """Bring streaming up to date after the match has been restored
+        from a snapshot taken `ticks` ticks in."""
+        self.ticks = ticks
+        self.stream(players)
+        for p in self.moving:
+            awake = self.streamer.awake(p)
+            if awake and p.asleep_since is not None:
+                p.wake(ticks, self.dt)
+            elif not awake and p.asleep_since is None:
+                p.sleep(ticks)
+
+    def render_chunk(self, layer, cx, cy, scale=1):
+        """Render one chunk of a layer, or None if it has no tiles at all.
+        The chunk is scaled down by `scale` if it's drawn at less than
+        full resolution."""
+        data = self.layers[layer][cy*CHUNK_TILES:(cy+1)*CHUNK_TILES,
+                                  cx*CHUNK_TILES:(cx+1)*CHUNK_TILES]
+        if not data.any():
+            return None
+        surf = pygame.Surface(self.chunk_size, pygame.SRCALPHA, 32)
+        self.generate_surface(surf, data)
+        if scale != 1:
+            surf = pygame.transform.smoothscale(
+                surf, (int(self.chunk_size.x * scale),
+                       int(self.chunk_size.y * scale)))
+        return convert(surf)
+
     def generate_surface(self, surf, data):
-        surf.convert_alpha()
-        for y in range(len(data)):
-            row = data[y].split(',')
-            for x in range(len(row)):
-                tile_id = row[x]
-                if tile_id == '':
-                    continue
-                pos = Vec2d(x*32, y*32)
-                self.tileset.draw(surf, int(tile_id), pos)
-
-    def draw(self, screen):
-        position = Vec2d(self.camera.x, 50*32-self.camera.y) - SCREEN_HALF
-        count = len(self.surfaces) - 1.
-
-        for i, surf in enumerate(self.surfaces):
+        """Fill the top left of `surf` with the tiles in `data`."""
+        pixels = self.tileset.render(data)
+        h, w = pixels.shape[:2]
+        # surfarray is indexed [x, y], hence all the transposing
+        rgb = pygame.surfarray.pixels3d(surf)
+        rgb[:w, :h] = pixels[:, :, :3].transpose(1, 0, 2)
+        del rgb  # unlocks the surface
+        alpha = pygame.surfarray.pixels_alpha(surf)
+        alpha[:w, :h] = pixels[:, :, 3].T
+        del alpha
+
+    def interpolated_camera(self, alpha):
+        return self.previous_camera.interpolate_to(self.camera, alpha)
+
+    def draw(self, screen, camera=None, scale=1):
+        if camera is None:
+            camera = self.camera
+        # everything in screen pixels, which are `scale` level pixels
+        map_size = self.map_size * scale
+        chunk_size = self.chunk_size * scale
+        half = Vec2d(screen.get_size()) / 2
+        position = Vec2d(camera.x, self.map_size.y-camera.y) * scale - half
+        count = max(len(self.layers) - 1., 1)
+        screen_clip = screen.get_clip()
+        blits = 0
+
+        for i in range(len(self.layers)):
             parallax_factor = i / count
 
             # constrain to the top and left
-            temp = position * parallax_factor
             offset = position * (1 - parallax_factor)
+            left = -position.x if offset.x < 0 else 0
+            top = -position.y if offset.y < 0 else 0
 
             # constrain to the bottom and right
-            size_offset = -position + self.map_size
+            size_offset = -position + map_size
+            clip = screen_clip.clip(pygame.Rect(
+                int(left), int(top),
+                int(max(size_offset.x, 0)), int(max(size_offset.y, 0))))
+            if not clip.width or not clip.height:
+                continue
+
+            # The layer pixel that lands on the top left of the screen
+            origin = position * parallax_factor
+            origin = Vec2d(int(origin.x), int(origin.y))
+
+            # Only visit the chunks that overlap the visible part
+            first_x = max(int((clip.left + origin.x) // chunk_size.x), 0)
+            first_y = max(int((clip.top + origin.y) // chunk_size.y), 0)
+            last_x = min(int((clip.right + origin.x) // chunk_size.x),
+                         self.chunk_count[0] - 1)
+            last_y = min(int((clip.bottom + origin.y) // chunk_size.y),
+                         self.chunk_count[1] - 1)
+
+            screen.set_clip(clip)
+            for cy in range(first_y, last_y + 1):
+                for cx in range(first_x, last_x + 1):
+                    chunk = self.chunks.get((i, cx, cy, scale))
+                    if chunk is None:
+                        continue  # nothing but empty tiles
+                    screen.blit(chunk, (cx*chunk_size.x - origin.x,
+                                        cy*chunk_size.y - origin.y))
+                    blits += 1
+        screen.set_clip(screen_clip)
+        return blits
+
 
-            # Get the part of the surface to blit
-            p = (-offset.x if offset.x < 0 else temp.x,
-                 -offset.y if offset.y < 0 else temp.y,
-                 size_offset.x, size_offset.y)
-            screen.blit(surf, (-position.x if offset.x < 0 else 0,
-                               -position.y if offset.y < 0 else 0), p)
+def _source_key(item):
+    """What tells one PlatformInfo or Box from another."""
+    if isinstance(item, Box):
+        return item
+    return (tuple(map(tuple, item.points)), item.jump_through, item.speed,
+            tuple(map(tuple, item.waypoints or ())))
 
 
 class Platform(object):
-    def __init__(self, points, jump_through=False, waypoints=None, speed=1):
+    # position, velocity, next waypoint and tick it fell asleep (-1 if it
+    # hasn't) of a moving platform
+    STATE = struct.Struct('<4dii')
+    radius = 5
+
+    def __init__(self, space, points, jump_through=False, waypoints=None,
+                 speed=1, box=None):
+        self.space = space
         self.waypoints = waypoints
         self.speed = speed
         self.target_index = 0
+        self.asleep_since = None
         is_moving = bool(self.waypoints)
 
         # Create the body type
         if is_moving:
             self.body = pymunk.Body(pymunk.inf, pymunk.inf)
         else:
-            self.body = SPACE.static_body
+            self.body = space.static_body
+
+        # the shapes, and the bounds of each relative to the body
+        self.shapes = []
+        self.bounds = []
+        if box is not None:
+            # a solid block instead of a polyline round the outside
+            left, bottom, right, top = box
+            # rounded off like the segments it stands in for
+            shape = pymunk.Poly(self.body, [(left, bottom), (left, top),
+                                            (right, top), (right, bottom)],
+                                radius=self.radius)
+            shape.friction = 1
+            shape.group = 1
+            space.add(shape)
+            self.shapes.append(shape)
+            self.bounds.append((left - self.radius, bottom - self.radius,
+                                right + self.radius, top + self.radius))
 
         for i in range(len(points)-1):
             # Make and configure the physics object
-            seg = pymunk.Segment(self.body, points[i], points[i+1], 5)
+            seg = pymunk.Segment(self.body, points[i], points[i+1],
+                                 self.radius)
             seg.friction = 1
             seg.group = 1
             if jump_through:
@@ -160,7 +385,75 @@ class Platform(object):
                 seg.color = THECOLORS["blue"]
                 seg.body.position = Vec2d(self.waypoints[0])
             # Add it to the world
-            SPACE.add(seg)
+            space.add(seg)
+            self.shapes.append(seg)
+            a, b = points[i], points[i+1]
+            self.bounds.append((min(a[0], b[0]) - self.radius,
+                                min(a[1], b[1]) - self.radius,
+                                max(a[0], b[0]) + self.radius,
+                                max(a[1], b[1]) + self.radius))
+
+        # ticks to go all the way round the waypoints, stop to stop
+        self.period = 0
+        if is_moving:
+            for i, stop in enumerate(self.waypoints):
+                start = Vec2d(self.waypoints[i - 1])
+                self.period += int(start.get_distance(stop) // speed) + 1
+
+    def get_state(self):
+        asleep_since = -1 if self.asleep_since is None else self.asleep_since
+        return (self.body.position.x, self.body.position.y,
+                self.body.velocity.x, self.body.velocity.y, self.target_index,
+                asleep_since)
+
+    def set_state(self, state):
+        x, y, vx, vy, self.target_index, asleep_since = state
+        self.body.position = (x, y)
+        self.body.velocity = (vx, vy)
+        if asleep_since < 0:
+            asleep_since = None
+        if (asleep_since is None) != (self.asleep_since is None):
+            if asleep_since is None:
+                self.space.add(*self.shapes)
+            else:
+                self.space.remove(*self.shapes)
+        self.asleep_since = asleep_since
+
+    def sleep(self, tick):
+        """Stop stepping and take our shapes out of the space."""
+        self.space.remove(*self.shapes)
+        self.asleep_since = tick
+
+    def wake(self, tick, dt):
+        """Catch up on the ticks missed since `sleep` and carry on."""
+        self.advance(tick - self.asleep_since, dt)
+        self.space.add(*self.shapes)
+        self.asleep_since = None
+
+    def advance(self, ticks, dt):
+        """Move as far as `ticks` calls to `update` would have, without
+        making them all."""
+        position = Vec2d(self.body.position)
+        lapped = False
+        while ticks > 0:
+            destination = Vec2d(self.waypoints[self.target_index])
+            distance = position.get_distance(destination)
+            needed = int(distance // self.speed) + 1
+            if ticks < needed:
+                if dt:
+                    direction = (destination - position).normalized()
+                    self.body.velocity = direction * self.speed / dt
+                position = position.interpolate_to(
+                    destination, ticks * self.speed / distance)
+                break
+            ticks -= needed
+            position = destination
+            self.target_index = (self.target_index + 1) % len(self.waypoints)
+            if not lapped:
+                # from a stop, every whole lap ends up right back there
+                ticks %= self.period
+                lapped = True
+        self.body.position = position
 
     def update(self, dt, players):
         if not self.waypoints:
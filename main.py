@@ -4,58 +4,145 @@ import pygame
 from pygame import locals as KEYS
 from pygame.color import THECOLORS
 
+import argparse
+import asyncio
+import random
 import sys
+import time
 
-from game import SCREEN_SIZE, SPACE
-from game import (PLAYER_COLLISION_TYPE, JUMP_THROUGH_COLLISION_TYPE,
-                  BULLET_COLLISION_TYPE)
-from game.player import Player
-from game.world import TileWorld
+from game import SCREEN_SIZE
+from game.assets import ASSETS
+from game.bots import BatchInput, ChaseController, bot_keys
+from game.controls import Controls, input_mask
+from game.hotreload import LevelWatcher
+from game.match import Match
+from game import net
+from game.pipeline import Pipeline
+from game.profiler import FrameProfiler
+from game.replay import DesyncError, Playback, Recorder, Replay
+from game.scaling import DynamicResolution
 
+# The simulation always advances in fixed steps of this many per second,
+# however fast or slow we happen to be rendering.
+TICK_RATE = 60
+# Never try to catch up more than this many seconds of simulation in one
+# rendered frame, or a long stall snowballs into an ever-longer catch-up.
+MAX_FRAME_TIME = .25
 
-def jump_through_collision_handler(space, arbiter):
-    # pass through only if going up
-    return arbiter.shapes[0].body.velocity.y < 0
+# Everything to have loaded before the match starts
+MANIFEST = {
+    'images': ["res/images/mininicular.png"],
+    'sheets': ["res/images/cat_gun_lightning.png",
+               "res/images/cat_gun_farmboy.png",
+               "res/images/cat_gun_tiger.png",
+               "res/images/cat_gun_sword.png"],
+    'sounds': ["res/sfx/C_28P.ogg", "res/sfx/fall.wav", "res/sfx/jump.wav"],
+}
 
 
-def bullet_collision_handler(space, arbiter):
-    arbiter.shapes[0].body.player.health -= 1
-    arbiter.shapes[1].body.bullet.destroy()
-    return True
+def create_controls(players):
+    """Keyboard controls for every player, and a gamepad each for as many
+    of them as there are gamepads plugged in."""
+    controls = Controls()
+    for pad, player in enumerate(players):
+        controls.bind_keys(player)
+        controls.bind_gamepad(player, pad)
+    return controls
 
 
-SPACE.gravity = (0, -1000)  # in px/sec^2
-SPACE.add_collision_handler(
-    PLAYER_COLLISION_TYPE, JUMP_THROUGH_COLLISION_TYPE,
-    begin=jump_through_collision_handler)
-SPACE.add_collision_handler(
-    PLAYER_COLLISION_TYPE, BULLET_COLLISION_TYPE,
-    begin=bullet_collision_handler)
+def show_loading_screen(screen, clock, loader):
+    """Draw a progress bar until the preloader is done."""
+    bar = pygame.Rect(0, 0, int(SCREEN_SIZE.x) // 2, 20)
+    bar.center = (int(SCREEN_SIZE.x) // 2, int(SCREEN_SIZE.y) // 2)
+    while loader.is_alive():
+        for event in pygame.event.get():
+            if event.type == KEYS.QUIT:
+                sys.exit()
+        screen.fill((54, 54, 54, 255))
+        pygame.draw.rect(screen, THECOLORS["white"], bar, 1)
+        filled = bar.inflate(-4, -4)
+        filled.width = int(filled.width * loader.progress)
+        pygame.draw.rect(screen, THECOLORS["white"], filled)
+        pygame.display.flip()
+        clock.tick(30)
+    loader.finish()
 
 
-def calculate_input(old_pressed_keys):
-    # Manage all events
-    for event in pygame.event.get():
-        pressed_window_x = event.type == KEYS.QUIT
-        pressed_esc = (event.type == KEYS.KEYDOWN and
-                       event.key in [KEYS.K_ESCAPE])
-        if pressed_window_x or pressed_esc:
-            sys.exit()
-    pressed = pygame.key.get_pressed()
-    # increment all pressed keys
-    for i, k in enumerate(pressed):
-        if k:
-            old_pressed_keys[i] = old_pressed_keys.get(i, 0) + 1
-    # clear out any keys that are no longer pressed
-    for k in list(old_pressed_keys.keys()):
-        if not pressed[k]:
-            del old_pressed_keys[k]
-    return old_pressed_keys
-
-
-def main():
-    fps = 60
-    dt = 1. / fps
+def create_match(level='levels/level.tmx', render=True, players=4,
+                 boxes=False):
+    """Set up a match with the usual four players sharing a keyboard, and
+    as many more as `players` asks for, for bots to play. `boxes` builds
+    the level's solid blocks out of boxes instead of their outlines."""
+    match = Match(level, render=render, boxes=boxes)
+    keyboard = [
+        dict(up=KEYS.K_UP, left=KEYS.K_LEFT, right=KEYS.K_RIGHT,
+             down=KEYS.K_DOWN, shoot=KEYS.K_SPACE),
+        dict(up=KEYS.K_w, left=KEYS.K_a, right=KEYS.K_d, down=KEYS.K_s,
+             shoot=KEYS.K_e),
+        dict(up=KEYS.K_i, left=KEYS.K_j, right=KEYS.K_l, down=KEYS.K_k,
+             shoot=KEYS.K_o),
+        dict(up=KEYS.K_KP5, left=KEYS.K_KP1, right=KEYS.K_KP3,
+             down=KEYS.K_KP2, shoot=KEYS.K_KP6),
+    ]
+    sheets = MANIFEST['sheets']
+    for i in range(players):
+        keys = keyboard[i] if i < len(keyboard) else bot_keys(i)
+        match.add_player("Player{}".format(i + 1), sheets[i % len(sheets)],
+                         **keys)
+    return match
+
+
+def run_headless(level='levels/level.tmx', frames=TICK_RATE * 60,
+                 input_source=None, profiler=None, after_step=None,
+                 players=4, boxes=False):
+    """Simulate a match as fast as possible, with no display or sound.
+
+    `input_source` is called as ``input_source(frame, players)`` each tick
+    and returns the pressed keys for that tick; without one, nobody presses
+    anything. `after_step`, if given, is called with the match after every
+    tick.
+    """
+    dt = 1. / TICK_RATE
+    match = create_match(level, render=False, players=players, boxes=boxes)
+    if profiler is not None:
+        match.profiler = profiler
+    pressed_keys = {}
+    for frame in range(frames):
+        if input_source is not None:
+            with match.profiler.phase("input"):
+                pressed_keys = input_source(frame, match.players)
+        match.step(pressed_keys, dt)
+        if after_step is not None:
+            after_step(match)
+        match.profiler.end_frame()
+    return match
+
+
+def main(level='levels/level.tmx', fps=60, profile=None, record=None,
+         replay=None, uncapped=False, players=4, resolution=None,
+         pipelined=False, watch=False, boxes=False):
+    """Play! F3 shows where the frame time goes, and `profile` names a .csv
+    or .json file to save every frame's timings to on the way out. Bots
+    play any `players` past the four at the keyboard.
+
+    `record` names a file to save a replay of the match to, while `replay`
+    watches one instead of playing. `uncapped` runs one tick per rendered
+    frame as fast as possible rather than in real time.
+
+    With a DynamicResolution as `resolution`, the match is drawn at
+    whatever resolution it picks to keep frames fast enough. `pipelined`
+    runs each frame's ticks on another thread while the ones before are
+    drawn. `watch` picks up changes to the level as it's edited, and
+    `boxes` builds its solid blocks out of boxes.
+    """
+    dt = 1. / TICK_RATE
+    playback = recorder = None
+    if replay:
+        replay = Replay.load(replay)
+        level, players = replay.level, replay.players
+        playback = Playback(replay)
+    elif record:
+        recorder = Recorder(level, tick_rate=TICK_RATE, players=players)
 
     # Initialize the game
     pygame.mixer.pre_init(frequency=44100, size=-16, channels=1, buffer=512)
@@ -63,58 +150,323 @@ def main():
     screen = pygame.display.set_mode((int(SCREEN_SIZE.x), int(SCREEN_SIZE.y)))
     clock = pygame.time.Clock()
     font = pygame.font.SysFont("Arial", 16)
+    profiler_font = pygame.font.SysFont("monospace", 14)
 
     # Music!
     pygame.mixer.music.load("res/music/fight.mp3")
     pygame.mixer.music.play(-1)  # loop forever
 
+    # Get all the images and sounds loaded while we wait
+    show_loading_screen(screen, clock, ASSETS.preload_in_background(MANIFEST))
+
     # Load the world
-    world = TileWorld('levels/level.tmx')
-    player1 = Player("Player1", "res/images/cat_gun_lightning.png",
-                     up=KEYS.K_UP, left=KEYS.K_LEFT,
-                     right=KEYS.K_RIGHT, down=KEYS.K_DOWN, shoot=KEYS.K_SPACE)
-    player2 = Player("Player2", "res/images/cat_gun_farmboy.png",
-                     up=KEYS.K_w, left=KEYS.K_a,
-                     right=KEYS.K_d, down=KEYS.K_s, shoot=KEYS.K_e)
-    player3 = Player("Player3", "res/images/cat_gun_tiger.png",
-                     up=KEYS.K_i, left=KEYS.K_j,
-                     right=KEYS.K_l, down=KEYS.K_k, shoot=KEYS.K_o)
-    player4 = Player("Player4", "res/images/cat_gun_sword.png",
-                     up=KEYS.K_KP5, left=KEYS.K_KP1,
-                     right=KEYS.K_KP3, down=KEYS.K_KP2, shoot=KEYS.K_KP6)
-    players = [player1, player2, player3, player4]
-
-    # track how long each key has been pressed
-    pressed_keys = {}
+    match = create_match(level, players=players, boxes=boxes)
+    profiler = match.profiler = FrameProfiler(keep_rows=bool(profile))
+
+    # A replay plays instead of anybody at the controls
+    if playback:
+        controls = Controls()
+        controls.add_source(playback)
+    else:
+        controls = create_controls(match.players[:4])
+        if players > 4:
+            controls.add_source(BatchInput(ChaseController(), first=4))
+
+    def poll():
+        with profiler.phase("input"):
+            controls.poll()
+        if controls.quit:
+            sys.exit()
+        if KEYS.K_F3 in controls.went_down:
+            profiler.visible = not profiler.visible
+
+    def tick():
+        # the match's profiler, as this may be on the pipeline's worker
+        with match.profiler.phase("input"):
+            pressed_keys = controls(match.frame, match.players)
+        if recorder:
+            recorder.record(pressed_keys)
+        match.step(pressed_keys, dt)
+        if recorder:
+            recorder.after_step(match)
+        if playback:
+            playback.after_step(match)
+
+    def reload():
+        changed = watcher.poll()
+        if changed:
+            print("Reloaded {}: {} chunks and {} platforms changed".format(
+                level, *changed))
 
     # Start the game loop
+    pipeline = Pipeline(match) if pipelined else None
+    watcher = LevelWatcher(match.world, level) if watch else None
+    accumulator = 0.
     running = True
-    while running:
-        # Input management
-        pressed_keys = calculate_input(pressed_keys)
-
-        # Update world
-        SPACE.step(dt)
-        world.update(dt, players)
-        for player in players:
-            player.update(pressed_keys)
-
-        # Draw stuff
-        screen.fill((54, 54, 54, 255))  # Dark gray color
-        world.draw(screen)
-        for player in players:
-            player.draw(screen, world.camera)
-        #import pymunk
-        #pymunk.pygame_util.draw(screen, SPACE)  # TODO: camera support
-        screen.blit(font.render("{} FPS".format(clock.get_fps()), 1,
-                                THECOLORS["white"]), (0, 0))
-
-        # Apply the drawing to the screen
-        pygame.display.flip()
+    try:
+        while running:
+            # Wait for next frame (an fps of 0 renders as fast as possible)
+            if uncapped:
+                clock.tick(0)
+                accumulator = dt
+            else:
+                accumulator += min(clock.tick(fps) / 1000., MAX_FRAME_TIME)
+
+            if pipeline:
+                # Draw where the last frame's ticks got to while this
+                # frame's run on the worker
+                view = pipeline.finish()
+                if watcher:
+                    reload()
+                ticks = int(accumulator // dt)
+                accumulator -= ticks * dt
+                poll()
+                pipeline.start(tick, ticks)
+            else:
+                if watcher:
+                    reload()
+                # Update world in fixed steps, polling input once per step
+                # so key hold counts stay in ticks
+                while accumulator >= dt:
+                    poll()
+                    tick()
+                    accumulator -= dt
+                view = match.view()
+            if playback:
+                running = not playback.done
+
+            # Draw stuff
+            surface, scale = screen, 1
+            if resolution:
+                # the frame before's time, not counting waiting for the cap
+                scale = resolution.update(clock.get_rawtime())
+                surface = resolution.surface(screen)
+            match.draw_view(surface, view, accumulator / dt, scale, profiler)
+            if resolution:
+                with profiler.phase("upscale"):
+                    resolution.present(surface, screen)
+                profiler.count("scale %", int(scale * 100))
+            screen.blit(font.render("{} FPS".format(clock.get_fps()), 1,
+                                    THECOLORS["white"]), (0, 0))
+            profiler.draw(screen, profiler_font)
+
+            # Apply the drawing to the screen
+            with profiler.phase("flip"):
+                pygame.display.flip()
+            profiler.end_frame()
+    finally:
+        if pipeline:
+            pipeline.close()
+        if profile:
+            profiler.export(profile)
+        if recorder:
+            recorder.save(record)
+
+
+async def play_online(address, fps=60, headless=False, frames=TICK_RATE * 60,
+                      **network):
+    """Join a match on a server at ``host:port``.
+
+    Everyone online plays with player one's keys (the arrows and space).
+    `headless` has a bot play for `frames` ticks with no window instead,
+    then reports on how the connection went. `network` is passed on to
+    net.Client for faking latency and packet loss.
+    """
+    host, port = address.rsplit(':', 1)
+    dt = 1. / TICK_RATE
+    if not headless:
+        pygame.mixer.pre_init(frequency=44100, size=-16, channels=1,
+                              buffer=512)
+        pygame.init()
+        screen = pygame.display.set_mode((int(SCREEN_SIZE.x),
+                                          int(SCREEN_SIZE.y)))
+        clock = pygame.time.Clock()
+        font = pygame.font.SysFont("Arial", 16)
+        show_loading_screen(screen, clock,
+                            ASSETS.preload_in_background(MANIFEST))
+
+    transport, client = await net.connect(
+        host, int(port),
+        lambda level, players: create_match(level, not headless, players),
+        tick_rate=TICK_RATE, **network)
+    try:
+        if headless:
+            from game.bots import RandomBot
+            bot = None
+            next_tick = time.time()
+            for _ in range(frames):
+                mask = 0
+                if client.match is not None:
+                    player = client.match.players[client.slot]
+                    if bot is None:
+                        bot = RandomBot(player, random.Random(client.slot))
+                    mask = input_mask(player, bot.keys())
+                client.tick(mask)
+                next_tick += dt
+                await asyncio.sleep(max(next_tick - time.time(), 0))
+            seconds = frames * dt
+            print("Sent {:.0f} B/s, received {:.0f} B/s; {} rollbacks "
+                  "replaying {:.1f} ticks each, last off by {:.1f}px".format(
+                      client.link.bytes / seconds,
+                      client.received_bytes / seconds, client.rollbacks,
+                      client.resimulated / max(client.rollbacks, 1),
+                      client.correction))
+            return
+
+        controls = Controls()
+        local = None
+        accumulator = 0.
+        while True:
+            frame_start = time.time()
+            accumulator += min(clock.tick() / 1000., MAX_FRAME_TIME)
+            while accumulator >= dt:
+                controls.poll()
+                if controls.quit:
+                    sys.exit()
+                if local is None and client.match is not None:
+                    local = client.match.players[0]
+                    controls.bind_keys(local)
+                    controls.bind_gamepad(local, 0)
+                pressed_keys = controls()
+                client.tick(input_mask(local, pressed_keys)
+                            if local else 0)
+                accumulator -= dt
+
+            if client.match is None:
+                screen.fill((54, 54, 54, 255))
+                status = "Connecting to {}...".format(address)
+            else:
+                client.match.draw(screen, accumulator / dt)
+                status = "{:.0f} FPS, player {}, corrected {:.1f}px".format(
+                    clock.get_fps(), client.slot + 1, client.correction)
+            screen.blit(font.render(status, 1, THECOLORS["white"]), (0, 0))
+            pygame.display.flip()
+            # sleep rather than clock.tick(fps) so packets keep coming in
+            spare = 1. / fps - (time.time() - frame_start) if fps else 0
+            await asyncio.sleep(max(spare, 0))
+    finally:
+        transport.close()
+
 
-        # Wait for next frame
-        clock.tick(fps)
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--level', default='levels/level.tmx')
+    parser.add_argument('--fps', type=int, default=60,
+                        help="render rate cap, 0 for uncapped")
+    parser.add_argument('--headless', action='store_true',
+                        help="simulate without a window as fast as possible")
+    parser.add_argument('--frames', type=int, default=TICK_RATE * 60,
+                        help="ticks to simulate in headless mode")
+    parser.add_argument('--profile', metavar='FILE',
+                        help="save per-frame timings to a .csv or .json file")
+    parser.add_argument('--record', metavar='FILE',
+                        help="save a replay of the match")
+    parser.add_argument('--replay', metavar='FILE',
+                        help="play back a replay instead of the keyboard")
+    parser.add_argument('--resync', action='store_true',
+                        help="with --replay --headless, carry on past "
+                        "desyncs from the keyframes rather than stopping")
+    parser.add_argument('--uncapped', action='store_true',
+                        help="simulate as fast as possible, not real time")
+    parser.add_argument('--serve', type=int, metavar='PORT',
+                        help="run a match for others to join over UDP")
+    parser.add_argument('--connect', metavar='HOST:PORT',
+                        help="join a match being served elsewhere")
+    parser.add_argument('--latency', type=float, default=0, metavar='MS',
+                        help="pretend every packet sent takes this long")
+    parser.add_argument('--jitter', type=float, default=0, metavar='MS',
+                        help="and up to this much longer on top")
+    parser.add_argument('--loss', type=float, default=0,
+                        help="pretend this fraction of packets get lost")
+    parser.add_argument('--players', type=int, default=4,
+                        help="cats in the arena; bots play all past four")
+    parser.add_argument('--bots', action='store_true',
+                        help="in headless mode, have bots play everybody")
+    parser.add_argument('--think-every', type=int, default=1, metavar='K',
+                        help="ticks between the bots' decisions")
+    parser.add_argument('--target-ms', type=float, metavar='MS',
+                        help="lower the resolution to keep frames this fast")
+    parser.add_argument('--min-scale', type=float, default=.5,
+                        help="with --target-ms, the lowest to go")
+    parser.add_argument('--max-scale', type=float, default=1.,
+                        help="with --target-ms, the highest to go")
+    parser.add_argument('--pipelined', action='store_true',
+                        help="simulate on another thread while drawing")
+    parser.add_argument('--watch', action='store_true',
+                        help="reload the level whenever it's saved")
+    parser.add_argument('--boxes', action='store_true',
+                        help="make solid blocks of tiles boxes, not outlines")
+    args = parser.parse_args(argv)
+    if args.boxes and (args.record or args.replay or args.serve or
+                       args.connect):
+        # replays and other players expect the level as it's usually built
+        parser.error("--boxes can't be recorded, replayed or played online")
+    return args
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    args = parse_args()
+    network = dict(latency=args.latency / 1000., jitter=args.jitter / 1000.,
+                   loss=args.loss)
+    if args.serve:
+        print("Serving {} on UDP port {}".format(args.level, args.serve))
+        asyncio.run(net.serve(create_match(args.level, render=False,
+                                           players=args.players),
+                              args.level, args.serve, tick_rate=TICK_RATE,
+                              **network))
+    elif args.connect:
+        asyncio.run(play_online(args.connect, args.fps, args.headless,
+                                args.frames, **network))
+    elif args.headless:
+        profiler = FrameProfiler(keep_rows=True) if args.profile else None
+        level, frames, source, hook = args.level, args.frames, None, None
+        if args.replay:
+            replay = Replay.load(args.replay)
+            level, frames = replay.level, replay.frames
+            args.players = replay.players
+            source = Playback(replay, strict=not args.resync)
+            hook = source.after_step
+        else:
+            if args.bots:
+                source = BatchInput(ChaseController(0),
+                                    every=args.think_every)
+            elif args.record:
+                # nobody's at the keyboard, so record the bots instead
+                from game.bots import BotInput
+                source = BotInput(0)
+            if args.record:
+                source = Recorder(level, seed=0, tick_rate=TICK_RATE,
+                                  source=source, players=args.players)
+                hook = source.after_step
+        start = time.time()
+        try:
+            run_headless(level, frames, input_source=source,
+                         profiler=profiler, after_step=hook,
+                         players=args.players, boxes=args.boxes)
+        except DesyncError as e:
+            sys.exit("Stopped: {}".format(e))
+        elapsed = time.time() - start
+        print("Simulated {} ticks in {:.2f}s ({:.0f} ticks/s)".format(
+            frames, elapsed, frames / max(elapsed, 1e-9)))
+        if args.replay and source.desyncs:
+            # resynced, or it would have stopped at the first
+            print("Desynced on {} of {} keyframes, first on frame {}: "
+                  "{}".format(len(source.desyncs), len(replay.keyframes),
+                              source.desyncs[0],
+                              " ".join(map(str, source.desyncs))))
+        elif args.replay:
+            print("Matched all {} keyframes".format(len(replay.keyframes)))
+        if profiler:
+            profiler.export(args.profile)
+        if args.record and not args.replay:
+            source.save(args.record)
+        if args.replay and source.desyncs:
+            sys.exit(1)
+    else:
+        resolution = None
+        if args.target_ms:
+            resolution = DynamicResolution(args.target_ms, args.min_scale,
+                                           args.max_scale)
+        main(args.level, args.fps, args.profile, args.record, args.replay,
+             args.uncapped, args.players, resolution, args.pipelined,
+             args.watch, args.boxes)
@@ -0,0 +1,107 @@
+"""Run lots of headless catformer matches in parallel and total the results.
+
+    python tournament.py --matches 10000 --output results.jsonl
+
+Every match runs in a worker process with bots at the controls. Results
+are written out one JSON line per match as they finish, so a long sweep
+that dies halfway still leaves everything it got through on disk.
+"""
+import argparse
+import json
+import multiprocessing
+import sys
+import time
+
+
+def run_match(job):
+    """Play one match in this process and report how it went."""
+    # imported here so the parent process never loads pygame
+    from game.bots import BotInput
+    from main import run_headless
+
+    start = time.time()
+    match = run_headless(job['level'], job['frames'],
+                         input_source=BotInput(job['seed']))
+    return {
+        'match': job['match'],
+        'level': job['level'],
+        'seed': job['seed'],
+        'frames': job['frames'],
+        'seconds': time.time() - start,
+        'players': [p.stats() for p in match.players],
+    }
+
+
+def make_jobs(count, levels, frames, seed=0):
+    for i in range(count):
+        yield {'match': i, 'level': levels[i % len(levels)],
+               'frames': frames, 'seed': seed + i}
+
+
+def run_tournament(jobs, processes=None, chunksize=4):
+    """Yield match results, in whatever order they finish.
+
+    Every match has its own physics space, so workers stay alive and play
+    match after match instead of paying process start-up for each one.
+    """
+    pool = multiprocessing.Pool(processes)
+    try:
+        for result in pool.imap_unordered(run_match, jobs, chunksize):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def summarize(results):
+    totals = {}
+    frames = 0
+    for result in results:
+        frames += result['frames']
+        for stats in result['players']:
+            total = totals.setdefault(stats['name'], {
+                'matches': 0, 'kills': 0, 'deaths': 0, 'damage_taken': 0})
+            total['matches'] += 1
+            for key in ('kills', 'deaths', 'damage_taken'):
+                total[key] += stats[key]
+    return {'matches': len(results), 'frames': frames, 'players': totals}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--matches', type=int, default=100)
+    parser.add_argument('--frames', type=int, default=60 * 60,
+                        help="ticks per match")
+    parser.add_argument('--level', action='append', dest='levels',
+                        help="level to play, repeat to rotate several")
+    parser.add_argument('--processes', type=int, default=None,
+                        help="worker processes, defaults to one per core")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="append per-match JSON lines here")
+    args = parser.parse_args(argv)
+
+    jobs = make_jobs(args.matches, args.levels or ['levels/level.tmx'],
+                     args.frames, args.seed)
+    output = open(args.output, 'a') if args.output else None
+    results = []
+    start = time.time()
+    try:
+        for result in run_tournament(jobs, args.processes):
+            results.append(result)
+            if output:
+                output.write(json.dumps(result) + '\n')
+                output.flush()
+            sys.stderr.write('\r{}/{} matches'.format(
+                len(results), args.matches))
+    finally:
+        if output:
+            output.close()
+    sys.stderr.write('\n')
+
+    summary = summarize(results)
+    summary['seconds'] = time.time() - start
+    print(json.dumps(summary, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()